@@ -0,0 +1,123 @@
+# Shared parts of benchmarks - preparation of benchmark DB and machine readable results
+#
+# Results of every benchmark are JSON document with environment and list of scenario results,
+# every scenario result has latency percentiles, throughput and peak RSS of benchmark process
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+from typing import Any, Dict, List
+
+from applifting_exercise.database import Database
+
+from .offers_simulator import add_simulator_arguments
+
+# Tables with data of app, they are truncated before every scenario
+DATA_TABLES = [
+    "users",
+    "products",
+    "offers",
+    "latest_offers",
+    "prices_hourly",
+    "prices_daily",
+    "product_reads",
+]
+
+
+def latency_summary(latencies_ms: List[float]) -> Dict[str, float]:
+    if len(latencies_ms) < 2:
+        latencies_ms = latencies_ms * 2 or [0.0, 0.0]
+
+    percentiles = statistics.quantiles(latencies_ms, n=100, method="inclusive")
+
+    return {
+        "p50": round(percentiles[49], 3),
+        "p95": round(percentiles[94], 3),
+        "p99": round(percentiles[98], 3),
+        "max": round(max(latencies_ms), 3),
+    }
+
+
+def peak_rss_mb() -> float:
+    # Peak RSS of benchmark process since its start, ru_maxrss is in kilobytes (bytes on macOS)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        max_rss //= 1024
+
+    return round(max_rss / 1024, 1)
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "commit": commit,
+        "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+    }
+
+
+def parse_arguments(parser: argparse.ArgumentParser) -> argparse.Namespace:
+    # Arguments shared by benchmarks against DB and offers service simulator
+    parser.add_argument("--dsn", default=os.environ.get("BENCHMARK_POSTGRES_DSN"))
+    parser.add_argument("--output", help="JSON results file, stdout by default")
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.dsn:
+        parser.error("Postgres DSN is required (--dsn or BENCHMARK_POSTGRES_DSN)")
+
+    return args
+
+
+def write_results(benchmark: str, args: argparse.Namespace, results: List[Dict[str, Any]]) -> None:
+    # Config of benchmark is stored with results, DSN is left out as it could contain password
+    document = {
+        "benchmark": benchmark,
+        "environment": environment(),
+        "config": {key: value for key, value in vars(args).items() if key != "dsn"},
+        "results": results,
+    }
+    text = json.dumps(document, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(text + "\n")
+    else:
+        print(text)
+
+
+async def reset_database(db: Database) -> None:
+    # Benchmarks need disposable DB, all app data are deleted
+    await db.ensure_schema()
+
+    async with db.pg_pool.acquire() as con:
+        await con.execute(f"TRUNCATE {', '.join(DATA_TABLES)} RESTART IDENTITY")
+
+
+async def create_products(db: Database, count: int) -> List[int]:
+    async with db.pg_pool.acquire() as con:
+        await con.copy_records_to_table(
+            "products",
+            records=[(f"Product {index}", "Benchmark product") for index in range(count)],
+            columns=["name", "description"],
+        )
+        records = await con.fetch("SELECT id FROM products ORDER BY id")
+
+    return [record["id"] for record in records]
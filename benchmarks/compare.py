@@ -0,0 +1,97 @@
+# Compare benchmark results with stored baseline of the same benchmark
+#
+# Metric is regression when it is worse than baseline by more than tolerance (relative),
+# exit code is 1 when any scenario has regression, so it could be used as CI check:
+#
+#   python -m benchmarks.compare results.json baseline.json --tolerance 0.1
+
+import argparse
+import json
+import sys
+from typing import Any, Dict, List, Optional
+
+# Compared metrics, metric path -> True when higher value is better
+METRICS = {
+    "throughput_rps": True,
+    "latency_ms.p50": False,
+    "latency_ms.p95": False,
+    "latency_ms.p99": False,
+    "peak_rss_mb": False,
+}
+
+
+def metric_value(result: Dict[str, Any], path: str) -> Optional[float]:
+    value: Any = result
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+
+    return float(value)
+
+
+def compare(
+    results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float
+) -> List[Dict[str, Any]]:
+    # Scenarios missing in baseline are skipped, relative change is positive when metric is worse
+
+    baseline_by_scenario = {result["scenario"]: result for result in baseline}
+    rows = []
+
+    for result in results:
+        baseline_result = baseline_by_scenario.get(result["scenario"])
+        if baseline_result is None:
+            continue
+
+        for path, higher_is_better in METRICS.items():
+            current = metric_value(result, path)
+            previous = metric_value(baseline_result, path)
+            if current is None or previous is None:
+                continue
+
+            worsening = previous - current if higher_is_better else current - previous
+            change = worsening / previous if previous else 0.0
+
+            rows.append(
+                {
+                    "scenario": result["scenario"],
+                    "metric": path,
+                    "baseline": previous,
+                    "current": current,
+                    "change": round(change, 4),
+                    "regression": change > tolerance,
+                }
+            )
+
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare benchmark results with baseline")
+    parser.add_argument("results", help="JSON results file")
+    parser.add_argument("baseline", help="JSON results file of baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative change")
+    args = parser.parse_args()
+
+    with open(args.results) as results_file:
+        results = json.load(results_file)
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    if results["benchmark"] != baseline["benchmark"]:
+        parser.error(f"Baseline is of {baseline['benchmark']} benchmark")
+
+    rows = compare(results["results"], baseline["results"], args.tolerance)
+    for row in rows:
+        print(
+            f"{row['scenario']:<24} {row['metric']:<16} {row['baseline']:>12.3f} "
+            f"{row['current']:>12.3f} {row['change']:>+8.1%}"
+            f"{'  REGRESSION' if row['regression'] else ''}"
+        )
+
+    if any(row["regression"] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# Local simulator of offers service for benchmarks, it replaces remote offers service
+#
+# Offers are answered after latency drawn from configured distribution, part of calls fails
+# with 503 by error rate. Random generator is seeded, so runs with same config are repeatable.
+# Simulator runs in own process to not share event loop with measured app:
+#
+#   python -m benchmarks.offers_simulator --simulator-port 9999 --latency lognormal --latency-ms 20
+#
+# App itself could use it by OFFERS_SERVICES_URL=http://localhost:9999/api/v1
+
+import argparse
+import asyncio
+import math
+import random
+import sys
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List
+
+from aiohttp import ClientError, ClientSession, web
+from aiohttp.web import Request, Response
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+# Seconds to wait for start of simulator process
+START_TIMEOUT = 10
+
+
+class OffersSimulator:
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        latency: str = "lognormal",
+        latency_ms: float = 20,
+        latency_sigma: float = 0.5,
+        error_rate: float = 0,
+        offers_per_product: int = 5,
+        seed: int = 0,
+    ) -> None:
+
+        if latency not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unsupported latency distribution {latency}")
+
+        # Latency is mean of distribution, median for lognormal distribution
+        self._latency = latency
+        self._latency_s = latency_ms / 1000
+        self._latency_sigma = latency_sigma
+        self._error_rate = error_rate
+        self._offers_per_product = offers_per_product
+        self._random = random.Random(seed)
+
+        self.app = web.Application()
+        self.app.router.add_route("POST", "/api/v1/auth", self.auth)
+        self.app.router.add_route("POST", "/api/v1/products/register", self.register_product)
+        self.app.router.add_route("GET", "/api/v1/products/{product_id}/offers", self.get_offers)
+
+    def _delay(self) -> float:
+        if self._latency == "fixed":
+            return self._latency_s
+
+        if self._latency == "uniform":
+            return self._random.uniform(0, 2 * self._latency_s)
+
+        if self._latency == "exponential":
+            return self._random.expovariate(1 / self._latency_s) if self._latency_s else 0
+
+        if not self._latency_s:
+            return 0
+
+        return self._random.lognormvariate(math.log(self._latency_s), self._latency_sigma)
+
+    @staticmethod
+    async def auth(_: Request) -> Response:
+        return web.json_response({"access_token": "SIMULATOR_TOKEN"}, status=201)
+
+    @staticmethod
+    async def register_product(request: Request) -> Response:
+        product = await request.json()
+
+        return web.json_response({"id": product["id"]}, status=201)
+
+    async def get_offers(self, request: Request) -> Response:
+        product_id = int(request.match_info["product_id"])
+        await asyncio.sleep(self._delay())
+
+        if self._random.random() < self._error_rate:
+            return web.json_response({"msg": "Simulated error"}, status=503)
+
+        # Offer IDs are stable per product, price and stock change with every call
+        first_offer_id = product_id * self._offers_per_product
+        offers = [
+            {
+                "id": first_offer_id + index,
+                "price": self._random.randint(100, 100000),
+                "items_in_stock": self._random.randint(0, 100),
+            }
+            for index in range(self._offers_per_product)
+        ]
+
+        return web.json_response(offers)
+
+
+def add_simulator_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--simulator-port", type=int, default=9999)
+    parser.add_argument("--latency", choices=LATENCY_DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--latency-ms", type=float, default=20, help="mean (lognormal median)")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="lognormal sigma")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of 503 responses")
+    parser.add_argument("--offers-per-product", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def simulator_arguments(args: argparse.Namespace) -> List[str]:
+    return [
+        f"--simulator-port={args.simulator_port}",
+        f"--latency={args.latency}",
+        f"--latency-ms={args.latency_ms}",
+        f"--latency-sigma={args.latency_sigma}",
+        f"--error-rate={args.error_rate}",
+        f"--offers-per-product={args.offers_per_product}",
+        f"--seed={args.seed}",
+    ]
+
+
+@asynccontextmanager
+async def simulator_process(args: argparse.Namespace) -> AsyncIterator[str]:
+    # Run simulator in subprocess until the end of block, yield URL of its API
+
+    # Stdout of benchmark is kept for JSON results
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "benchmarks.offers_simulator",
+        *simulator_arguments(args),
+        stdout=asyncio.subprocess.DEVNULL,
+    )
+    url = f"http://localhost:{args.simulator_port}/api/v1"
+
+    try:
+        async with ClientSession() as session:
+            for _ in range(START_TIMEOUT * 10):
+                try:
+                    async with session.post(f"{url}/auth", raise_for_status=True):
+                        break
+                except ClientError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("Offers simulator did not start")
+
+        yield url
+    finally:
+        process.terminate()
+        await process.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offers service simulator")
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+
+    simulator = OffersSimulator(
+        args.latency,
+        args.latency_ms,
+        args.latency_sigma,
+        args.error_rate,
+        args.offers_per_product,
+        args.seed,
+    )
+    web.run_app(simulator.app, port=args.simulator_port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
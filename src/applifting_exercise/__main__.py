@@ -1,61 +1,228 @@
+import argparse
 import asyncio
+import logging
+import signal
+import time
+from contextlib import contextmanager
 from importlib import resources
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterator, Optional
 
+from aiohttp import ClientError, ClientSession
 from pyhocon import ConfigFactory
 
 from .core import Core
 from .database import Database
+from .metrics import REGISTRY
+from .password_hasher import PasswordHasher
 from .services import OffersService
 from .web import WebServer
+from .workers import Supervisor
 
+LOGGER = logging.getLogger(__name__)
 
-class App:
-    def __init__(self) -> None:
+# Seconds between retries of offers service auth during startup
+AUTH_RETRY_INTERVAL = 5
+
+
+@contextmanager
+def startup_phase(name: str) -> Iterator[None]:
+    started_at = time.perf_counter()
+    yield
+    LOGGER.info("Startup phase %s took %.3f seconds", name, time.perf_counter() - started_at)
+
+
+def set_event_loop_policy(config: Dict[str, Any]) -> None:
+    # uvloop is optional dependency, it is imported only when it is configured
+    event_loop = str(config["general"].get("event_loop", "asyncio"))
+
+    if event_loop == "uvloop":
+        import uvloop  # pylint: disable=import-outside-toplevel, import-error
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    elif event_loop != "asyncio":
+        raise ValueError(f"Unsupported event loop {event_loop}")
+
+
+def worker_pool_config(pg_config: Dict[str, Any], workers: int) -> Dict[str, Any]:
+    # Pool sizes of config are budget of whole app for every DB server,
+    # every worker gets equal share of it
+    max_size = int(pg_config.get("max_size", 10)) // workers
+    if max_size < 1:
+        raise ValueError(f"DB pool max size is lower than count of workers {workers}")
+
+    min_size = min(int(pg_config.get("min_size", 10)), max_size)
+
+    return {**pg_config, "min_size": min_size, "max_size": max_size}
+
+
+class App:  # pylint: disable=too-many-instance-attributes
+    def __init__(self, worker_index: Optional[int] = None, workers: int = 1) -> None:
+        # Index of worker process, None when app runs in single process
+        self.worker_index = worker_index
+        self.workers = workers
         self.db: Optional[Database] = None
         self.core: Optional[Core] = None
         self.web_server: Optional[WebServer] = None
         self.offers_service: Optional[OffersService] = None
+        self.password_hasher: Optional[PasswordHasher] = None
+        self._auth_task: Optional["asyncio.Task[None]"] = None
 
         # Load config.conf file with all required configurations fields
         with resources.path(__package__, "config.conf") as config_path:
             self.config: Dict[str, Any] = ConfigFactory.parse_file(config_path)
 
+    @property
+    def leader(self) -> bool:
+        # The first worker refreshes offers and maintains DB partitions
+        return self.worker_index in (None, 0)
+
+    async def _authenticate_offers_service(self, setup_started_at: float) -> None:
+        # Auth is retried until offers service answers, meanwhile read endpoints are served
+        # and calls of offers service try to authenticate by themselves
+        assert self.offers_service is not None
+
+        while not self.offers_service.authenticated:
+            try:
+                await self.offers_service.authenticate()
+            except (ClientError, asyncio.TimeoutError) as e:
+                LOGGER.warning(
+                    "Offers service auth failed (%r), retry in %s seconds", e, AUTH_RETRY_INTERVAL
+                )
+                await asyncio.sleep(AUTH_RETRY_INTERVAL)
+
+        LOGGER.info("App is ready in %.3f seconds", time.perf_counter() - setup_started_at)
+
     async def setup(self) -> None:
-        self.db = await Database.async_init(self.config["postgres"])
-        await self.db.ensure_schema()
+        # Offers service auth runs concurrently with DB setup and it is not awaited,
+        # app starts serving before it and it is reported as not ready until auth succeeds
+        setup_started_at = time.perf_counter()
+
+        self.offers_service = OffersService(ClientSession(), None, self.config["offers"])
+        self._auth_task = asyncio.create_task(
+            self._authenticate_offers_service(setup_started_at)
+        )
+
+        postgres_config = self.config["postgres"]
+        product_cache_config = self.config["product_cache"]
+        metrics_port = None
+        if self.worker_index is not None:
+            # Every worker is scraped on own metrics port, its series are labelled by worker
+            REGISTRY.const_labels["worker"] = str(self.worker_index)
+            metrics_port = int(self.config["web"]["metrics_port"]) + self.worker_index
+
+            # Product writes are seen only by worker handling them, other workers must not
+            # read products from own cache or from replicas not replaying the write yet
+            postgres_config = {
+                **worker_pool_config(postgres_config, self.workers),
+                "replicas": {**postgres_config["replicas"], "read_products": False},
+            }
+            product_cache_config = {**product_cache_config, "max_size": 0}
+
+        with startup_phase("database"):
+            self.db = await Database.async_init(postgres_config, self.config["offers_history"])
+            # Workers get schema already ensured by supervisor
+            if self.worker_index is None:
+                await self.db.ensure_schema()
 
-        # Call offers service and store header with auth token for other calls
-        self.offers_service = await OffersService.async_init(self.config["offers"])
+        self.password_hasher = PasswordHasher(self.config["password_hashing"])
 
         self.core = Core(
             offers_service=self.offers_service,
             db=self.db,
             app_internal_token=self.config["general"]["app_internal_token"],
+            password_hasher=self.password_hasher,
+            product_cache_config=product_cache_config,
+            offers_refresh_config={**self.config["offers_refresh"], "enabled": self.leader},
         )
+        with startup_phase("offers snapshot"):
+            await self.core.load_offers_snapshot()
 
-        self.web_server = WebServer(self.core, self.config["web"]["port"])
+        self.web_server = WebServer(
+            self.core,
+            self.config["web"]["port"],
+            self.config["web"]["token_cache_size"],
+            self.config["web"]["tracing"],
+            metrics_port,
+        )
+        LOGGER.info("App is set up in %.3f seconds", time.perf_counter() - setup_started_at)
+
+    async def ensure_schema(self) -> None:
+        self.db = await Database.async_init(self.config["postgres"], self.config["offers_history"])
+        await self.db.ensure_schema()
+
+    async def backfill_prices_rollups(self) -> None:
+        await self.ensure_schema()
+        assert self.db is not None
+        await self.db.backfill_prices_rollups()
 
     async def run(self) -> None:
         assert self.web_server is not None
         assert self.core is not None
 
-        await asyncio.gather(self.web_server.start_web_server(), self.core.background_tasks())
+        await asyncio.gather(
+            self.web_server.start_web_server(reuse_port=self.worker_index is not None),
+            self.core.background_tasks(),
+        )
 
     async def aclose(self) -> None:
+        if self._auth_task:
+            self._auth_task.cancel()
+
         if self.web_server:
             await self.web_server.aclose()
 
+        if self.core:
+            await self.core.aclose()
+
         if self.db:
             await self.db.aclose()
 
         if self.offers_service:
             await self.offers_service.aclose()
 
+        if self.password_hasher:
+            await self.password_hasher.aclose()
+
 
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Applifting exercise app")
+    parser.add_argument(
+        "--backfill-rollups",
+        action="store_true",
+        help="compute prices rollups from all stored offers and exit",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="count of processes serving web port, overrides web.workers of config",
+    )
+    args = parser.parse_args()
+
     app = App()
+    workers = args.workers or int(app.config["web"]["workers"])
+    set_event_loop_policy(app.config)
     loop = asyncio.get_event_loop()
+
+    if args.backfill_rollups:
+        try:
+            loop.run_until_complete(app.backfill_prices_rollups())
+        finally:
+            loop.run_until_complete(app.aclose())
+            loop.close()
+        return
+
+    if workers > 1:
+        # Schema is ensured once before workers start, then workers are supervised until stop
+        worker_pool_config(app.config["postgres"], workers)
+        try:
+            loop.run_until_complete(app.ensure_schema())
+        finally:
+            loop.run_until_complete(app.aclose())
+            loop.close()
+
+        Supervisor(workers, run_worker).run()
+        return
+
     loop.run_until_complete(app.setup())
 
     try:
@@ -65,3 +232,26 @@ def main() -> None:
     finally:
         loop.run_until_complete(app.aclose())
         loop.close()
+
+
+def run_worker(worker_index: int, workers: int) -> None:
+    # Worker is stopped by SIGTERM from supervisor, SIGINT of terminal is handled by supervisor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    app = App(worker_index, workers)
+    set_event_loop_policy(app.config)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        loop.run_until_complete(app.setup())
+
+        run_task = loop.create_task(app.run())
+        loop.add_signal_handler(signal.SIGTERM, run_task.cancel)
+        try:
+            loop.run_until_complete(run_task)
+        except asyncio.CancelledError:
+            pass
+    finally:
+        loop.run_until_complete(app.aclose())
+        loop.close()
@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Generic, Hashable, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    # Bounded in-process cache, least recently used entry is evicted when cache is full
+    # Every entry has own expiration, expired entries are removed on access
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._entries: "OrderedDict[K, Tuple[V, float]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __getitem__(self, key: K) -> V:
+        # Raise KeyError when entry is missing or expired
+        try:
+            value, expires_at = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            raise
+
+        if expires_at <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            raise KeyError(key)
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return value
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def set(self, key: K, value: V, ttl: float) -> None:
+        if self._max_size <= 0 or ttl <= 0:
+            return
+
+        self._entries[key] = (value, time.time() + ttl)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: K) -> None:
+        self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "max_size": self._max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
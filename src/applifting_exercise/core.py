@@ -1,36 +1,243 @@
 import asyncio
+import logging
+import time
+from collections import Counter
 from datetime import datetime, timedelta
-from typing import List, Tuple, cast
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 
-import bcrypt
+import asyncpg
 from jose import jwt
 
+from .cache import LRUCache
 from .database import Database
 from .exceptions import (
+    DatabaseOverloaded,
     InvalidPassword,
     NewUserIsAlreadyExists,
+    PricesNotExists,
     ProductIdNotExists,
     UserIsNotExists,
 )
-from .models import Offer, Product, Price
+from .metrics import (
+    OFFERS_INGESTED,
+    OFFERS_REFRESH_LAG,
+    OFFERS_REFRESH_THROUGHPUT,
+    OFFERS_REFRESHED_PRODUCTS,
+    OFFERS_WRITE_DURATION,
+    monitor_event_loop_lag,
+)
+from .models import Offer, Price, PriceBucket, Product
+from .password_hasher import PasswordHasher
+from .refresh_coordinator import RefreshCoordinator
+from .refresh_scheduler import RefreshScheduler
 from .services import OffersService
-from operator import attrgetter
 
+LOGGER = logging.getLogger(__name__)
+
+# Count of products with reads waiting for write to DB, reads of other products are dropped
+PENDING_READS_SIZE = 10000
 
-class Core:
-    def __init__(
-        self, offers_service: OffersService, db: Database, app_internal_token: str
+
+class Core:  # pylint: disable=too-many-instance-attributes
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        offers_service: OffersService,
+        db: Database,
+        app_internal_token: str,
+        password_hasher: Optional[PasswordHasher] = None,
+        product_cache_config: Optional[Dict[str, Union[int, float]]] = None,
+        offers_refresh_config: Optional[Dict[str, Any]] = None,
     ) -> None:
 
         self._offers_service = offers_service
         self._db = db
+        self._password_hasher = password_hasher or PasswordHasher()
+
+        # Products (and not found products as None) read from DB
+        product_cache_config = product_cache_config or {}
+        self._product_cache = LRUCache[int, Optional[Product]](
+            int(product_cache_config.get("max_size", 10000))
+        )
+        self._product_cache_ttl = float(product_cache_config.get("ttl", 30))
+        self._product_cache_negative_ttl = float(product_cache_config.get("negative_ttl", 5))
+        # Reads of products from DB in progress, product ID -> count of reads
+        # Product written during its read could be read before the write, it is not cached
+        self._product_reads: "Counter[int]" = Counter()
+        self._products_written_during_read: Set[int] = set()
+
+        # Current offers of products from the latest offers update, product ID -> offers
+        # Offers lists are replaced, never modified in place
+        self._offers_snapshot: Dict[int, List[Offer]] = {}
+        # Results of offers service calls in the latest offers update or stats period
+        self._offers_cycle_stats: Dict[str, int] = {}
+        # Refreshed products and written offers since start of stats window
+        self._refresh_window_stats: "Counter[str]" = Counter()
+        self._refresh_window_started_at = time.monotonic()
+
+        # Offers update pipeline - fetchers push offers of products into bounded queue
+        # and writer inserts them into DB in batches
+        offers_refresh_config = offers_refresh_config or {}
+        # Only one process of app refreshes offers, others read offers from DB
+        self._refresh_enabled = bool(offers_refresh_config.get("enabled", True))
+        self._refresh_scheduler = RefreshScheduler(offers_refresh_config)
+        OFFERS_REFRESH_LAG.set_function(lambda: self._refresh_scheduler.stats()["lag"])
+        self._refresh_coordinator = RefreshCoordinator(
+            db, offers_refresh_config.get("coordination")
+        )
+        # Seconds between reading of products for scheduler and logging of refresh stats
+        self._refresh_sync_interval = float(offers_refresh_config.get("sync_interval", 60))
+        self._refresh_products_batch_size = int(
+            offers_refresh_config.get("products_batch_size", 1000)
+        )
+        self._refresh_fetchers = int(offers_refresh_config.get("fetchers", 50))
+        self._refresh_queue_size = int(offers_refresh_config.get("queue_size", 100))
+        self._refresh_batch_size = int(offers_refresh_config.get("batch_size", 1000))
+        self._refresh_flush_interval = float(offers_refresh_config.get("flush_interval", 1))
+        # Reads of products refreshed by other processes, product ID -> time of last read
+        # They are written to DB in batches and process refreshing product takes them on sync
+        self._pending_reads: Dict[int, float] = {}
+        self._reads_flush_interval = float(offers_refresh_config.get("reads_flush_interval", 5))
 
         self.app_internal_token = app_internal_token
 
     async def background_tasks(self) -> None:
+        # Offers refresh and partitions maintenance run only in process with refresh enabled
+        tasks = [
+            self._db.monitor_replicas(),
+            monitor_event_loop_lag(),
+            self._flush_pending_reads_task(),
+        ]
+        if self._refresh_enabled:
+            tasks += [self._refresh_offers_task(), self._maintain_offers_partitions_task()]
+
+        await asyncio.gather(*tasks)
+
+    async def _refresh_offers_task(self) -> None:
+        # Offers of every owned product are refreshed when product is due by refresh scheduler
+        await asyncio.gather(
+            self._refresh_coordinator.run(self._refresh_slots_changed),
+            self._sync_refresh_scheduler_task(),
+            self._run_offers_pipeline(self._next_owned_product_id, self._refresh_scheduler.done),
+        )
+
+    async def _next_owned_product_id(self) -> int:
+        # Products of slots released since last sync are dropped from schedule
         while True:
-            await self._update_offers()
-            await asyncio.sleep(60)
+            product_id = await self._refresh_scheduler.next_due()
+            if self._refresh_coordinator.owns(product_id):
+                return product_id
+
+            self._refresh_scheduler.remove(product_id)
+
+    async def _refresh_slots_changed(self) -> None:
+        # Other replicas refresh products of released slots, their snapshot offers would be
+        # stale when slots come back, so they are read from DB until refreshed here again
+        for product_id in [
+            product_id
+            for product_id in self._offers_snapshot
+            if not self._refresh_coordinator.owns(product_id)
+        ]:
+            del self._offers_snapshot[product_id]
+
+        await self._sync_refresh_scheduler()
+
+    async def _sync_refresh_scheduler(self) -> None:
+        # Reads of owned products in other processes are taken after products are scheduled
+        slots_count = self._refresh_coordinator.slots_count
+        owned_slots = sorted(self._refresh_coordinator.owned_slots)
+
+        try:
+            await self._refresh_scheduler.sync(
+                self._db.iter_products_ids(
+                    self._refresh_products_batch_size, slots_count, owned_slots
+                )
+            )
+            reads_ago = await self._db.pop_product_reads(slots_count, owned_slots)
+        except (asyncpg.PostgresError, DatabaseOverloaded):
+            LOGGER.exception("Reading of products for offers refresh failed")
+            return
+
+        for product_id, read_ago in reads_ago.items():
+            self._refresh_scheduler.record_read(product_id, read_ago)
+
+    def _record_read(self, product_id: int) -> None:
+        if self._refreshes(product_id):
+            self._refresh_scheduler.record_read(product_id)
+        elif len(self._pending_reads) < PENDING_READS_SIZE or product_id in self._pending_reads:
+            self._pending_reads[product_id] = time.monotonic()
+
+    async def _flush_pending_reads(self) -> None:
+        if not self._pending_reads:
+            return
+
+        now = time.monotonic()
+        reads_ago = {
+            product_id: now - read_at for product_id, read_at in self._pending_reads.items()
+        }
+        self._pending_reads = {}
+
+        try:
+            await self._db.record_product_reads(reads_ago)
+        except (asyncpg.PostgresError, DatabaseOverloaded):
+            LOGGER.exception("Writing of product reads failed")
+
+    async def _flush_pending_reads_task(self) -> None:
+        while True:
+            await asyncio.sleep(self._reads_flush_interval)
+            await self._flush_pending_reads()
+
+    async def _sync_refresh_scheduler_task(self) -> None:
+        while True:
+            await self._sync_refresh_scheduler()
+            await asyncio.sleep(self._refresh_sync_interval)
+
+            self._offers_cycle_stats = self._offers_service.pop_cycle_stats()
+            LOGGER.info(
+                "Offers service calls - %s, offers refresh - %s, refresh schedule - %s",
+                self._offers_cycle_stats,
+                self._pop_refresh_window_stats(),
+                self._refresh_scheduler.stats(),
+            )
+
+    def _pop_refresh_window_stats(self) -> Dict[str, float]:
+        # Refresh pipeline never finishes, so its throughput is reported per stats window
+        now = time.monotonic()
+        window = now - self._refresh_window_started_at
+        products_per_second = self._refresh_window_stats["products"] / window if window else 0
+
+        window_stats = {
+            "products": self._refresh_window_stats["products"],
+            "inserted": self._refresh_window_stats["inserted"],
+            "skipped": self._refresh_window_stats["skipped"],
+            "products_per_second": round(products_per_second, 1),
+        }
+        OFFERS_REFRESH_THROUGHPUT.set(products_per_second)
+
+        self._refresh_window_stats.clear()
+        self._refresh_window_started_at = now
+
+        return window_stats
+
+    async def _maintain_offers_partitions_task(self) -> None:
+        while True:
+            await asyncio.sleep(self._db.maintenance_interval)
+
+            try:
+                await self._db.maintain_offers_partitions()
+            except (asyncpg.PostgresError, DatabaseOverloaded):
+                LOGGER.exception("Maintenance of offers partitions failed")
 
     def _generate_token(self, user_id: int, username: str) -> str:
         # Generate jwt token with expiration one hour
@@ -43,7 +250,7 @@ class Core:
         return cast(str, generated_token)
 
     async def register(self, username: str, password: str) -> str:
-        hashed_pwd = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+        hashed_pwd = await self._password_hasher.hash_password(password)
 
         # Check if user is exists and store new user and hashed password into DB
         user_id = await self._db.register_user(username, hashed_pwd)
@@ -58,7 +265,7 @@ class Core:
         if user is None:
             raise UserIsNotExists
 
-        if not bcrypt.checkpw(password.encode(), user.hashed_pwd):
+        if not await self._password_hasher.check_password(password, user.hashed_pwd):
             raise InvalidPassword
 
         return self._generate_token(user.id, user.username)
@@ -72,66 +279,272 @@ class Core:
             await self._db.delete_product(product.id)
             raise RuntimeError("Product was not registered into offers service")
 
+        # Product ID could be cached as not found before
+        self._invalidate_product(product.id)
+        if self._refreshes(product.id):
+            self._refresh_scheduler.add(product.id, delay=0)
+
         return product.id
 
     async def get_product(self, product_id: int) -> Product:
-        product = await self._db.get_product(product_id)
+        try:
+            product = self._product_cache[product_id]
+        except KeyError:
+            product = await self._read_product(product_id)
 
         if not product:
             raise ProductIdNotExists
 
         return product
 
+    async def _read_product(self, product_id: int) -> Optional[Product]:
+        self._product_reads[product_id] += 1
+        try:
+            product = await self._db.get_product(product_id)
+        finally:
+            self._product_reads[product_id] -= 1
+            written = product_id in self._products_written_during_read
+            if not self._product_reads[product_id]:
+                del self._product_reads[product_id]
+                self._products_written_during_read.discard(product_id)
+
+        if not written:
+            # Not found products are cached shortly to protect DB from scans over missing IDs
+            ttl = self._product_cache_ttl if product else self._product_cache_negative_ttl
+            self._product_cache.set(product_id, product, ttl)
+
+        return product
+
+    def _invalidate_product(self, product_id: int) -> None:
+        # Called after write of product is done
+        self._product_cache.invalidate(product_id)
+        if product_id in self._product_reads:
+            self._products_written_during_read.add(product_id)
+
     async def update_product(self, product: Product) -> None:
         updated = await self._db.update_product(product)
+        self._invalidate_product(product.id)
 
         if updated != "UPDATE 1":
             raise ProductIdNotExists
 
     async def delete_product(self, product_id: int) -> None:
         deleted = await self._db.delete_product(product_id)
+        self._invalidate_product(product_id)
+        self._refresh_scheduler.remove(product_id)
+
+        self._offers_snapshot.pop(product_id, None)
 
         if deleted != "DELETE 1":
             raise ProductIdNotExists
 
+    def _refreshes(self, product_id: int) -> bool:
+        return self._refresh_enabled and self._refresh_coordinator.owns(product_id)
+
+    async def load_offers_snapshot(self) -> None:
+        if not self._refresh_enabled:
+            return
+
+        self._offers_snapshot = await self._db.get_latest_offers_all()
+
     async def get_offers(self, product_id: int) -> List[Offer]:
-        offers_list = await self._db.get_offers(product_id)
+        self._record_read(product_id)
 
-        return offers_list
+        # Offers of products refreshed by other replicas or processes are read from DB
+        offers_list = None
+        if self._refreshes(product_id):
+            offers_list = self._offers_snapshot.get(product_id)
 
-    async def get_offers_all(self, product_id: int) -> List[Offer]:
-        offers_all_list = await self._db.get_offers_all(product_id)
+        if offers_list is None:
+            offers_list = await self._db.get_offers(product_id)
 
-        return offers_all_list
+        return offers_list
+
+    async def iter_offers_all(
+        self,
+        product_id: int,
+        *,
+        from_date: Optional[datetime] = None,
+        to_date: Optional[datetime] = None,
+        after: Optional[Tuple[datetime, int]] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[Offer]:
+
+        async for offer in self._db.iter_offers_all(
+            product_id, from_date=from_date, to_date=to_date, after=after, limit=limit
+        ):
+            yield offer
 
     async def get_prices(
-        self, product_id: int, from_date: datetime, to_date: datetime
-    ) -> Tuple[List[Price], int]:
+        self, product_id: int, from_date: datetime, to_date: datetime, include_prices: bool = True
+    ) -> Tuple[Optional[List[Price]], int]:
 
-        prices_from_to = await self._db.get_prices_from_to(product_id, from_date, to_date)
+        self._record_read(product_id)
+        percentage = await self._db.get_prices_percentage(product_id, from_date, to_date)
 
-        newest_price = max(prices_from_to, key=attrgetter("created_at"))
-        oldest_price = min(prices_from_to, key=attrgetter("created_at"))
+        if percentage is None:
+            raise PricesNotExists
 
-        if newest_price.value == oldest_price.value:
-            percentage = 100
-        elif newest_price.value > oldest_price.value:
-            percentage = int((newest_price.value / oldest_price.value) * 100 - 100)
-        else:
-            percentage = int(100 - (newest_price.value / oldest_price.value) * 100)
+        # Full list of prices is read only when it is required
+        prices_from_to = None
+        if include_prices:
+            prices_from_to = await self._db.get_prices_from_to(product_id, from_date, to_date)
 
         return prices_from_to, percentage
 
+    async def get_prices_history(
+        self, product_id: int, from_date: datetime, to_date: datetime, bucket: timedelta
+    ) -> List[PriceBucket]:
+
+        return await self._db.get_prices_history(product_id, from_date, to_date, bucket)
+
     async def _update_offers(self) -> None:
-        products_ids = await self._db.get_all_products_ids()
-        coroutines = [self._offers_service.get_offers(product_id) for product_id in products_ids]
-        offers_results = await asyncio.gather(*coroutines)
+        # Refresh offers of all products once, used by tests and benchmarks
+        products_ids = self._db.iter_products_ids(self._refresh_products_batch_size)
+        products_ids_lock = asyncio.Lock()
+
+        async def next_product_id() -> Optional[int]:
+            # Fetchers share one products IDs iterator, so every product is fetched once
+            async with products_ids_lock:
+                return await anext(products_ids, None)
+
+        await self._run_offers_pipeline(next_product_id)
+
+        self._offers_cycle_stats = self._offers_service.pop_cycle_stats()
+        LOGGER.info(
+            "Offers service calls - %s, offers refresh - %s",
+            self._offers_cycle_stats,
+            self._pop_refresh_window_stats(),
+        )
 
-        offers_list = []
-        for offers in [offers for offers in offers_results if offers]:
-            offers_list.extend(offers)
+    async def _run_offers_pipeline(
+        self,
+        next_product_id: Callable[[], Awaitable[Optional[int]]],
+        product_fetched: Optional[Callable[[int], None]] = None,
+    ) -> None:
+        # Fetch offers of products given by next_product_id until it returns None
+        # and write them into DB, product_fetched is called after each fetch
+
+        offers_queue: "asyncio.Queue[Optional[List[Offer]]]" = asyncio.Queue(
+            self._refresh_queue_size
+        )
 
-        await self._db.insert_new_offers(offers_list)
+        async def fetch_offers() -> None:
+            while True:
+                product_id = await next_product_id()
+                if product_id is None:
+                    return
+
+                try:
+                    offers = await self._offers_service.get_offers(product_id)
+                finally:
+                    if product_fetched:
+                        product_fetched(product_id)
+
+                if offers:
+                    OFFERS_REFRESHED_PRODUCTS.inc()
+                    self._refresh_window_stats["products"] += 1
+                    await offers_queue.put(offers)
+
+        async def fetch_all_offers() -> None:
+            fetchers = [asyncio.create_task(fetch_offers()) for _ in range(self._refresh_fetchers)]
+            try:
+                await asyncio.gather(*fetchers)
+            finally:
+                for fetcher in fetchers:
+                    fetcher.cancel()
+
+            # Tell writer that no more offers will come
+            await offers_queue.put(None)
+
+        fetch_task = asyncio.create_task(fetch_all_offers())
+        write_task = asyncio.create_task(self._write_offers(offers_queue))
+        try:
+            await asyncio.gather(fetch_task, write_task)
+        finally:
+            # Failed stage stops the other one, else both are already done
+            fetch_task.cancel()
+            write_task.cancel()
+
+    async def _write_offers(self, offers_queue: "asyncio.Queue[Optional[List[Offer]]]") -> None:
+        # Insert offers from queue in batches, batch is flushed when it reaches batch size
+        # or flush interval after its first offers, return after None is received
+
+        loop = asyncio.get_running_loop()
+        # Pending get is kept between batches, cancelled get could lose offers taken from queue
+        get_task: Optional["asyncio.Task[Optional[List[Offer]]]"] = None
+        finished = False
+
+        try:
+            while not finished:
+                # All fetched offers are written into history, snapshot gets the latest fetch
+                # when product was fetched more times within one batch
+                batch: List[Offer] = []
+                fresh_offers: Dict[int, List[Offer]] = {}
+                flush_at: Optional[float] = None
+
+                while len(batch) < self._refresh_batch_size:
+                    if get_task is None:
+                        get_task = asyncio.create_task(offers_queue.get())
+
+                    timeout = None if flush_at is None else max(flush_at - loop.time(), 0)
+                    done, _ = await asyncio.wait({get_task}, timeout=timeout)
+                    if not done:
+                        break
+
+                    offers = get_task.result()
+                    get_task = None
+                    if offers is None:
+                        finished = True
+                        break
+
+                    if flush_at is None:
+                        flush_at = loop.time() + self._refresh_flush_interval
+
+                    fresh_offers[offers[0].product_id] = offers
+                    batch.extend(offers)
+
+                if not batch:
+                    continue
+
+                write_started_at = time.perf_counter()
+                try:
+                    insert_result = await self._db.insert_new_offers(batch)
+                except (asyncpg.PostgresError, DatabaseOverloaded):
+                    # Offers of batch are fetched again in next refresh of their products
+                    LOGGER.exception("Insert of offers batch failed")
+                    continue
+
+                OFFERS_WRITE_DURATION.observe(time.perf_counter() - write_started_at)
+                OFFERS_INGESTED.inc(("inserted",), insert_result.inserted)
+                OFFERS_INGESTED.inc(("skipped",), insert_result.skipped)
+                self._refresh_window_stats["inserted"] += insert_result.inserted
+                self._refresh_window_stats["skipped"] += insert_result.skipped
+
+                # Products without fresh offers keep their previous offers same as in DB
+                self._offers_snapshot.update(fresh_offers)
+        finally:
+            if get_task is not None:
+                get_task.cancel()
 
     async def is_alive(self) -> bool:
         return await self._db.is_connected()
+
+    def is_ready(self) -> bool:
+        # Read endpoints are served before offers service is authenticated, app is ready after it
+        return self._offers_service.authenticated
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        return {"products": self._product_cache.stats()}
+
+    def database_stats(self) -> Dict[str, Any]:
+        return {"replicas": self._db.replicas_stats()}
+
+    def offers_refresh_stats(self) -> Dict[str, Any]:
+        return {**self._refresh_scheduler.stats(), **self._refresh_coordinator.stats()}
+
+    async def aclose(self) -> None:
+        await self._refresh_coordinator.aclose()
+
+    def offers_service_stats(self) -> Dict[str, Any]:
+        return {**self._offers_service.stats(), "last_cycle": self._offers_cycle_stats}
@@ -1,33 +1,444 @@
+# pylint: disable=too-many-lines
+
+import asyncio
 import logging
-from datetime import datetime
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from importlib import resources
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple, Union
 
 import asyncpg
 from asyncpg.exceptions import CannotConnectNowError, ConnectionDoesNotExistError
 
-from .models import Offer, Price, Product, User
+from .database_replicas import REPLICA_CONNECTION_ERRORS, ReplicaSet
+from .exceptions import DatabaseOverloaded
+from .metrics import DB_POOL_ACQUIRE_DURATION, DB_POOL_IN_USE, DB_POOL_SIZE
+from .models import Offer, OffersInsertResult, Price, PriceBucket, Product, User
+from .tracing import Span, add_span
 
 LOGGER = logging.getLogger(__name__)
 
+# Rollup tables of prices with their bucket width, from the coarsest one
+PRICES_ROLLUPS = (
+    ("prices_daily", "day", timedelta(days=1)),
+    ("prices_hourly", "hour", timedelta(hours=1)),
+)
+
+# Key of transaction advisory lock, offers inserts hold it shared while they merge offers into
+# rollups and backfill holds it exclusively while it replaces rollups of one day, so increments
+# of offers committed during backfill are not overwritten
+PRICES_ROLLUPS_LOCK_KEY = 7_001_012
+
+ROLLUP_INSERT_SQL = """
+    INSERT INTO
+        {rollup} (
+            product_id, bucket_start, open_price, open_created_at, close_price, close_created_at,
+            high, low, prices_sum, items_in_stock_sum, prices_count
+        )
+    SELECT
+        product_id,
+        date_trunc('{unit}', created_at) AS bucket_start,
+        (array_agg(price ORDER BY created_at, id))[1],
+        MIN(created_at),
+        (array_agg(price ORDER BY created_at DESC, id DESC))[1],
+        MAX(created_at),
+        MAX(price),
+        MIN(price),
+        SUM(price),
+        SUM(items_in_stock),
+        COUNT(*)
+    FROM
+        {source}
+    GROUP BY
+        product_id, bucket_start
+    ON CONFLICT (product_id, bucket_start) DO UPDATE SET
+"""
+
+# Merge new offers into existing rollup buckets
+ROLLUP_MERGE_SQL = """
+    open_price = CASE
+        WHEN EXCLUDED.open_created_at < {rollup}.open_created_at THEN EXCLUDED.open_price
+        ELSE {rollup}.open_price
+    END,
+    open_created_at = LEAST(EXCLUDED.open_created_at, {rollup}.open_created_at),
+    close_price = CASE
+        WHEN EXCLUDED.close_created_at >= {rollup}.close_created_at THEN EXCLUDED.close_price
+        ELSE {rollup}.close_price
+    END,
+    close_created_at = GREATEST(EXCLUDED.close_created_at, {rollup}.close_created_at),
+    high = GREATEST(EXCLUDED.high, {rollup}.high),
+    low = LEAST(EXCLUDED.low, {rollup}.low),
+    prices_sum = EXCLUDED.prices_sum + {rollup}.prices_sum,
+    items_in_stock_sum = EXCLUDED.items_in_stock_sum + {rollup}.items_in_stock_sum,
+    prices_count = EXCLUDED.prices_count + {rollup}.prices_count
+"""
+
+# Replace rollup buckets computed again from all offers
+ROLLUP_REPLACE_SQL = """
+    open_price = EXCLUDED.open_price,
+    open_created_at = EXCLUDED.open_created_at,
+    close_price = EXCLUDED.close_price,
+    close_created_at = EXCLUDED.close_created_at,
+    high = EXCLUDED.high,
+    low = EXCLUDED.low,
+    prices_sum = EXCLUDED.prices_sum,
+    items_in_stock_sum = EXCLUDED.items_in_stock_sum,
+    prices_count = EXCLUDED.prices_count
+"""
+
+
+# Queries on hot paths, asyncpg prepares every query once per connection on its first use
+# and reuses prepared statement from connection statement cache (statement_cache_size)
+# Statements prepared by Connection.prepare can not be kept, they are invalidated
+# when connection is released to pool
+HOT_QUERIES = {
+    "get_user": """
+    SELECT
+        id, username, hashed_pwd
+    FROM
+        users
+    WHERE
+        username = $1
+""",
+    "get_product": """
+    SELECT
+        id, "name", description
+    FROM
+        products
+    WHERE
+        id = $1
+""",
+    "get_offers": """
+    SELECT
+        id, product_id, price, items_in_stock, created_at
+    FROM
+        latest_offers
+    WHERE
+        product_id = $1
+""",
+    "get_prices_from_to": """
+    SELECT
+        price, created_at
+    FROM
+        offers
+    WHERE
+        product_id = $1
+    AND
+        created_at BETWEEN $2 AND $3
+    ORDER BY
+        created_at
+""",
+    "get_prices_percentage": """
+    SELECT
+        CASE
+            WHEN newest.price = oldest.price
+                THEN 100
+            WHEN newest.price > oldest.price
+                THEN trunc(newest.price::NUMERIC / oldest.price * 100 - 100)
+            ELSE
+                trunc(100 - newest.price::NUMERIC / oldest.price * 100)
+        END::INT
+    FROM
+        (
+            SELECT price
+            FROM offers
+            WHERE product_id = $1 AND created_at BETWEEN $2 AND $3
+            ORDER BY created_at, id
+            LIMIT 1
+        ) AS oldest,
+        (
+            SELECT price
+            FROM offers
+            WHERE product_id = $1 AND created_at BETWEEN $2 AND $3
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1
+        ) AS newest
+""",
+    "iter_products_ids": """
+    SELECT
+        id
+    FROM
+        products
+    WHERE
+        id > $1
+    AND
+        id % $3 = ANY($4::INT[])
+    ORDER BY
+        id
+    LIMIT $2
+""",
+}
+
+
+PARTITION_INTERVALS = ("day", "week")
+OFFERS_CURSOR_PREFETCH = 1000
+
+
+class Database:  # pylint: disable=too-many-public-methods, too-many-instance-attributes
+    def __init__(
+        self,
+        pg_pool: asyncpg.pool.Pool,
+        offers_history_config: Optional[Dict[str, Union[str, int]]] = None,
+        acquire_timeout: Optional[float] = None,
+        replicas: Optional[ReplicaSet] = None,
+    ) -> None:
 
-class Database:
-    def __init__(self, pg_pool: asyncpg.pool.Pool) -> None:
         self.pg_pool = pg_pool
+        # Seconds to wait for free connection, DatabaseOverloaded is raised after it
+        self._acquire_timeout = acquire_timeout
+        # Read replicas for product reads, without replicas all queries go to primary
+        self._replicas = replicas
+        DB_POOL_SIZE.set_function(pg_pool.get_size, ("primary",))
+        DB_POOL_IN_USE.set_function(
+            lambda: pg_pool.get_size() - pg_pool.get_idle_size(), ("primary",)
+        )
+
+        offers_history_config = offers_history_config or {}
+        self._partition_interval = str(offers_history_config.get("partition_interval", "day"))
+        self._partitions_ahead = int(offers_history_config.get("partitions_ahead", 3))
+        self._retention = timedelta(days=int(offers_history_config.get("retention_days", 90)))
+        self._retention_action = str(offers_history_config.get("retention_action", "drop"))
+        self.maintenance_interval = int(offers_history_config.get("maintenance_interval", 3600))
+
+        if self._partition_interval not in PARTITION_INTERVALS:
+            raise ValueError(f"Unsupported offers partition interval {self._partition_interval}")
+
+        if self._retention_action not in ("drop", "detach"):
+            raise ValueError(f"Unsupported offers retention action {self._retention_action}")
 
     @classmethod
-    async def async_init(cls, pg_config: Dict[str, Any]) -> "Database":
+    async def async_init(
+        cls,
+        pg_config: Dict[str, Any],
+        offers_history_config: Optional[Dict[str, Union[str, int]]] = None,
+    ) -> "Database":
+
+        # Other keys are passed to pool (size, connections lifetime, statement cache size)
+        pg_config = dict(pg_config)
+        acquire_timeout = pg_config.pop("acquire_timeout", None)
+        replicas_config = pg_config.pop("replicas", None) or {}
+
         pg_pool = await asyncpg.create_pool(**pg_config)
+        replicas = await ReplicaSet.async_init(pg_config, replicas_config)
+
+        return cls(pg_pool, offers_history_config, acquire_timeout, replicas)
+
+    async def _acquire_connection(
+        self, pg_pool: asyncpg.pool.Pool, pool_name: str
+    ) -> asyncpg.connection.Connection:
+
+        acquire_started_at = time.perf_counter()
+
+        try:
+            con = await pg_pool.acquire(timeout=self._acquire_timeout)
+        except asyncio.TimeoutError as e:
+            LOGGER.warning(
+                "No free DB connection in %s pool in %s seconds", pool_name, self._acquire_timeout
+            )
+            raise DatabaseOverloaded from e
+
+        acquire_duration = time.perf_counter() - acquire_started_at
+        DB_POOL_ACQUIRE_DURATION.observe(acquire_duration, (pool_name,))
+        add_span("db.acquire", acquire_duration)
+
+        return con
+
+    @asynccontextmanager
+    async def _acquire(
+        self, query_name: str, read_product_id: Optional[int] = None
+    ) -> AsyncIterator[asyncpg.connection.Connection]:
+        # Wait for connection and use of connection are recorded as spans of traced request
+        # Reads of product data (read_product_id is set) go to healthy replica if any,
+        # replica failing to give connection is marked unhealthy and read falls back to primary
+
+        replicas = self._replicas
+        replica = None
+        if replicas is not None and read_product_id is not None:
+            replica = replicas.pick(read_product_id)
 
-        return cls(pg_pool)
+        con = None
+        if replicas is not None and replica is not None:
+            pg_pool = replica.pool
+            try:
+                con = await self._acquire_connection(pg_pool, replica.name)
+            except REPLICA_CONNECTION_ERRORS:
+                LOGGER.exception("Connection to DB %s failed", replica.name)
+                replicas.mark_unhealthy(replica)
+            except DatabaseOverloaded:
+                # Hanging replica or its full pool, next reads do not wait for it until it is
+                # healthy again by health check
+                replicas.mark_unhealthy(replica)
+
+        if con is None:
+            pg_pool = self.pg_pool
+            con = await self._acquire_connection(pg_pool, "primary")
+
+        try:
+            with Span(f"db.{query_name}"):
+                yield con
+        finally:
+            await pg_pool.release(con)
+
+    def _record_product_write(self, product_id: int) -> None:
+        # Product written by this process is read from primary until replicas replay the write
+        if self._replicas is not None:
+            self._replicas.record_write(product_id)
 
     async def ensure_schema(self) -> None:
-        async with self.pg_pool.acquire() as con:
-            with resources.path(__package__, "database_schema.sql") as sql_schema_path:
-                await con.execute(sql_schema_path.read_text())
+        async with self._acquire("ensure_schema") as con:
+            async with con.transaction():
+                legacy_offers = await self._rename_legacy_offers(con)
+
+                with resources.path(__package__, "database_schema.sql") as sql_schema_path:
+                    await con.execute(sql_schema_path.read_text())
+
+                if legacy_offers:
+                    await self._move_legacy_offers(con)
+
+                # Fill latest offers from already stored offers (only once when table is empty)
+                await con.execute(
+                    """
+                        INSERT INTO
+                            latest_offers (product_id, id, price, items_in_stock, created_at)
+                        SELECT
+                            product_id, id, price, items_in_stock, created_at
+                        FROM
+                            offers
+                        WHERE
+                            (product_id, created_at) IN (
+                                SELECT product_id, MAX(created_at) FROM offers GROUP BY product_id
+                            )
+                        AND
+                            NOT EXISTS (SELECT 1 FROM latest_offers)
+                        ON CONFLICT DO NOTHING
+                    """
+                )
+
+        await self.maintain_offers_partitions()
+
+    @staticmethod
+    async def _rename_legacy_offers(con: asyncpg.connection.Connection) -> bool:
+        # Offers table created before partitioning is renamed to make place for partitioned one
+        # Return True if legacy table was found
+
+        legacy_offers = await con.fetchval(
+            "SELECT relkind = 'r' FROM pg_class WHERE oid = to_regclass('offers')"
+        )
+        if not legacy_offers:
+            return False
+
+        LOGGER.info("Migrating offers table to partitioned table")
+        await con.execute(
+            """
+                ALTER TABLE offers RENAME TO offers_legacy;
+                ALTER TABLE offers_legacy DROP CONSTRAINT IF EXISTS offers_pkey;
+                DROP INDEX IF EXISTS offers_product_id_created_at_idx;
+            """
+        )
+
+        return True
+
+    async def _move_legacy_offers(self, con: asyncpg.connection.Connection) -> None:
+        await self._create_offers_partitions_for(con, "offers_legacy")
+
+        await con.execute(
+            """
+                INSERT INTO
+                    offers (id, product_id, price, items_in_stock, created_at)
+                SELECT
+                    id, product_id, price, items_in_stock, created_at
+                FROM
+                    offers_legacy
+                ON CONFLICT DO NOTHING;
+
+                DROP TABLE offers_legacy;
+            """
+        )
+
+    def _partition_bounds(self, moment: datetime) -> Tuple[datetime, datetime]:
+        # Return start and end of offers partition which contains given moment
+
+        start = datetime(moment.year, moment.month, moment.day)
+        if self._partition_interval == "week":
+            start -= timedelta(days=start.weekday())
+            return start, start + timedelta(weeks=1)
+
+        return start, start + timedelta(days=1)
+
+    async def _create_offers_partition(
+        self, con: asyncpg.connection.Connection, moment: datetime
+    ) -> None:
+
+        start, end = self._partition_bounds(moment)
+
+        # DDL could not use query arguments, bounds are formatted datetime values only
+        await con.execute(
+            f"""
+                CREATE TABLE IF NOT EXISTS
+                    offers_p{start:%Y%m%d}
+                PARTITION OF
+                    offers
+                FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')
+            """
+        )
+
+    async def _create_offers_partitions_for(
+        self, con: asyncpg.connection.Connection, source_table: str
+    ) -> None:
+        # Create offers partitions for all offers stored in source table
+
+        partitions_starts = await con.fetch(
+            f"SELECT DISTINCT date_trunc($1, created_at) AS start FROM {source_table}",
+            self._partition_interval,
+        )
+        for record in partitions_starts:
+            await self._create_offers_partition(con, record["start"])
+
+    async def maintain_offers_partitions(self) -> None:
+        # Create offers partitions ahead and drop or detach partitions older than retention
+
+        now = datetime.utcnow()
+        step = timedelta(weeks=1) if self._partition_interval == "week" else timedelta(days=1)
+
+        async with self._acquire("maintain_offers_partitions") as con:
+            for partition_index in range(self._partitions_ahead + 1):
+                await self._create_offers_partition(con, now + partition_index * step)
+
+            partitions_records = await con.fetch(
+                """
+                    SELECT
+                        child.relname AS name,
+                        pg_get_expr(child.relpartbound, child.oid) AS bound
+                    FROM
+                        pg_inherits
+                    JOIN
+                        pg_class AS child ON child.oid = pg_inherits.inhrelid
+                    WHERE
+                        pg_inherits.inhparent = 'offers'::regclass
+                """
+            )
+
+            for record in partitions_records:
+                # Bound is in format `FOR VALUES FROM ('<start>') TO ('<end>')`
+                bound_end = re.search(r"TO \('([^']+)'\)", record["bound"])
+                if not bound_end or datetime.fromisoformat(bound_end[1]) > now - self._retention:
+                    continue
+
+                if self._retention_action == "detach":
+                    await con.execute(f"ALTER TABLE offers DETACH PARTITION {record['name']}")
+                else:
+                    await con.execute(f"DROP TABLE {record['name']}")
+
+                LOGGER.info(
+                    "Offers partition %s is out of retention - %s",
+                    record["name"],
+                    self._retention_action,
+                )
 
     async def register_user(self, username: str, hashed_pwd: bytes) -> Optional[int]:
-        async with self.pg_pool.acquire() as con:
+        async with self._acquire("register_user") as con:
             user_id = await con.fetchval(
                 """
                     INSERT INTO
@@ -44,23 +455,13 @@ class Database:
         return int(user_id) if user_id else None
 
     async def get_user(self, username: str) -> Optional[User]:
-        async with self.pg_pool.acquire() as con:
-            user_record = await con.fetchrow(
-                """
-                    SELECT
-                        id, username, hashed_pwd
-                    FROM
-                        users
-                    WHERE
-                        username = $1
-                """,
-                username,
-            )
+        async with self._acquire("get_user") as con:
+            user_record = await con.fetchrow(HOT_QUERIES["get_user"], username)
 
         return User(**user_record) if user_record else None
 
     async def create_product(self, name: str, description: str) -> Product:
-        async with self.pg_pool.acquire() as con:
+        async with self._acquire("create_product") as con:
             product_id = await con.fetchval(
                 """
                     INSERT INTO
@@ -73,26 +474,21 @@ class Database:
                 description,
             )
 
+        self._record_product_write(product_id)
+
         return Product(product_id, name, description)
 
     async def get_product(self, product_id: int) -> Optional[Product]:
-        async with self.pg_pool.acquire() as con:
-            product_record = await con.fetchrow(
-                """
-                    SELECT
-                        id, "name", description
-                    FROM
-                        products
-                    WHERE
-                        id = $1
-                """,
-                product_id,
-            )
+        replicas = self._replicas
+        read_product_id = product_id if replicas is not None and replicas.read_products else None
+
+        async with self._acquire("get_product", read_product_id=read_product_id) as con:
+            product_record = await con.fetchrow(HOT_QUERIES["get_product"], product_id)
 
         return Product(**product_record) if product_record else None
 
     async def update_product(self, product: Product) -> str:
-        async with self.pg_pool.acquire() as con:
+        async with self._acquire("update_product") as con:
             updated = await con.execute(
                 """
                     UPDATE
@@ -107,10 +503,12 @@ class Database:
                 product.description,
             )
 
+        self._record_product_write(product.id)
+
         return str(updated)
 
     async def delete_product(self, product_id: int) -> str:
-        async with self.pg_pool.acquire() as con:
+        async with self._acquire("delete_product") as con:
             deleted = await con.execute(
                 """
                     DELETE FROM
@@ -121,124 +519,636 @@ class Database:
                 product_id,
             )
 
+        self._record_product_write(product_id)
+
         return str(deleted)
 
-    async def get_all_products_ids(self) -> List[int]:
-        async with self.pg_pool.acquire() as con:
-            product_ids_records = await con.fetch(
-                """
-                    SELECT
-                        id
-                    FROM
-                        products
-                """
-            )
+    async def iter_products_ids(
+        self, batch_size: int, slots_count: int = 1, slots: Sequence[int] = (0,)
+    ) -> AsyncIterator[int]:
+        # Walk products ordered by ID in batches, every batch continues after the last read ID
+        # Only products with product_id % slots_count in slots are returned
+        # Connection is held only while batch is read
 
-        return [product_id["id"] for product_id in product_ids_records]
+        last_product_id = 0
 
-    async def insert_new_offers(self, offers_list: List[Offer]) -> None:
-        async with self.pg_pool.acquire() as con:
-            await con.executemany(
-                """
-                    INSERT INTO
-                        offers (id, product_id, price, items_in_stock, created_at)
-                    VALUES ($1, $2, $3, $4, $5)
-                    ON CONFLICT DO NOTHING
-                """,
-                [
+        while True:
+            async with self._acquire("iter_products_ids") as con:
+                product_ids_records = await con.fetch(
+                    HOT_QUERIES["iter_products_ids"],
+                    last_product_id,
+                    batch_size,
+                    slots_count,
+                    list(slots),
+                )
+
+            for product_id in product_ids_records:
+                yield product_id["id"]
+
+            if len(product_ids_records) < batch_size:
+                return
+
+            last_product_id = product_ids_records[-1]["id"]
+
+    async def insert_new_offers(self, offers_list: List[Offer]) -> OffersInsertResult:
+        # Bulk load offers with binary COPY into temporary (not WAL logged) staging table
+        # and merge them into offers with one set-based insert
+        # Offers history keeps changes of offers - duplicates and offers with the same price
+        # and items in stock as their previous fetch (staged before or latest offer) are skipped
+
+        if not offers_list:
+            return OffersInsertResult(inserted=0, skipped=0)
+
+        async with self._acquire("insert_new_offers") as con:
+            async with con.transaction():
+                await con.execute(
+                    "SELECT pg_advisory_xact_lock_shared($1)", PRICES_ROLLUPS_LOCK_KEY
+                )
+                # Staging table lives for the whole pooled connection, rows are dropped on commit
+                await con.execute(
+                    """
+                        CREATE TEMPORARY TABLE IF NOT EXISTS
+                            offers_staging (LIKE offers)
+                        ON COMMIT DELETE ROWS
+                    """
+                )
+                await con.copy_records_to_table(
+                    "offers_staging",
+                    records=[
+                        (
+                            offer.id,
+                            offer.product_id,
+                            offer.price,
+                            offer.items_in_stock,
+                            offer.created_at,
+                        )
+                        for offer in offers_list
+                    ],
+                    columns=["id", "product_id", "price", "items_in_stock", "created_at"],
+                )
+                await self._create_offers_partitions_for(con, "offers_staging")
+
+                # Only really inserted offers are added into prices rollups
+                rollups_upserts = ", ".join(
+                    f"{rollup}_upsert AS ("
+                    + ROLLUP_INSERT_SQL.format(rollup=rollup, unit=unit, source="inserted")
+                    + ROLLUP_MERGE_SQL.format(rollup=rollup)
+                    + ")"
+                    for rollup, unit, _ in PRICES_ROLLUPS
+                )
+                inserted = await con.fetchval(
+                    f"""
+                        WITH staged AS (
+                            SELECT
+                                id,
+                                product_id,
+                                price,
+                                items_in_stock,
+                                created_at,
+                                LAG((price, items_in_stock)) OVER (
+                                    PARTITION BY product_id, id ORDER BY created_at
+                                ) AS previous_fetch
+                            FROM
+                                offers_staging
+                        ),
+                        inserted AS (
+                            INSERT INTO
+                                offers (id, product_id, price, items_in_stock, created_at)
+                            SELECT
+                                staged.id,
+                                staged.product_id,
+                                staged.price,
+                                staged.items_in_stock,
+                                staged.created_at
+                            FROM
+                                staged
+                            LEFT JOIN
+                                latest_offers
+                            ON
+                                latest_offers.product_id = staged.product_id
+                            AND
+                                latest_offers.id = staged.id
+                            AND
+                                latest_offers.created_at < staged.created_at
+                            WHERE
+                                (staged.price, staged.items_in_stock) IS DISTINCT FROM COALESCE(
+                                    staged.previous_fetch,
+                                    (latest_offers.price, latest_offers.items_in_stock)
+                                )
+                            ON CONFLICT DO NOTHING
+                            RETURNING
+                                id, product_id, price, items_in_stock, created_at
+                        ),
+                        {rollups_upserts}
+                        SELECT COUNT(*) FROM inserted
+                    """
+                )
+                await self._replace_latest_offers(con)
+
+        return OffersInsertResult(inserted=inserted, skipped=len(offers_list) - inserted)
+
+    @staticmethod
+    async def _replace_latest_offers(con: asyncpg.connection.Connection) -> None:
+        # Replace latest offers of products in staging table with their newest staged offers
+        # Older offers than already stored latest offers are ignored
+
+        await con.execute(
+            """
+                DELETE FROM
+                    latest_offers
+                USING
                     (
-                        offer.id,
-                        offer.product_id,
-                        offer.price,
-                        offer.items_in_stock,
-                        offer.created_at,
+                        SELECT product_id, MAX(created_at) AS created_at
+                        FROM offers_staging
+                        GROUP BY product_id
+                    ) AS newest_staged
+                WHERE
+                    latest_offers.product_id = newest_staged.product_id
+                AND
+                    latest_offers.created_at < newest_staged.created_at
+            """
+        )
+        await con.execute(
+            """
+                INSERT INTO
+                    latest_offers (product_id, id, price, items_in_stock, created_at)
+                SELECT DISTINCT ON (product_id, id)
+                    product_id, id, price, items_in_stock, created_at
+                FROM
+                    offers_staging
+                WHERE
+                    (product_id, created_at) IN (
+                        SELECT product_id, MAX(created_at) FROM offers_staging GROUP BY product_id
                     )
-                    for offer in offers_list
-                ],
-            )
+                AND
+                    NOT EXISTS (
+                        SELECT 1
+                        FROM latest_offers
+                        WHERE
+                            latest_offers.product_id = offers_staging.product_id
+                        AND
+                            latest_offers.created_at > offers_staging.created_at
+                    )
+                ON CONFLICT (product_id, id) DO UPDATE SET
+                    price = EXCLUDED.price,
+                    items_in_stock = EXCLUDED.items_in_stock,
+                    created_at = EXCLUDED.created_at
+            """
+        )
 
-    async def get_offers(self, product_id: int) -> List[Offer]:
-        async with self.pg_pool.acquire() as con:
-            offers_records = await con.fetch(
+    async def backfill_prices_rollups(self) -> None:
+        # Compute prices rollups again from all stored offers, one day in each transaction
+
+        async with self._acquire("backfill_prices_rollups") as con:
+            first_day, last_day = await con.fetchrow(
                 """
                     SELECT
-                        id, product_id, price, items_in_stock, created_at
+                        date_trunc('day', MIN(created_at)), date_trunc('day', MAX(created_at))
                     FROM
                         offers
-                    WHERE
-                        product_id = $1
-                    AND
-                        created_at = (SELECT MAX(created_at) FROM offers WHERE product_id = $1)
-                """,
-                product_id,
+                """
             )
 
-        offers_list = []
+            day = first_day
+            while day is not None and day <= last_day:
+                async with con.transaction():
+                    # Offers inserts wait until rollups of the day are replaced
+                    await con.execute("SELECT pg_advisory_xact_lock($1)", PRICES_ROLLUPS_LOCK_KEY)
+                    for rollup, unit, _ in PRICES_ROLLUPS:
+                        source = (
+                            "(SELECT * FROM offers WHERE created_at >= $1 AND created_at < $2)"
+                            " AS day_offers"
+                        )
+                        await con.execute(
+                            ROLLUP_INSERT_SQL.format(rollup=rollup, unit=unit, source=source)
+                            + ROLLUP_REPLACE_SQL,
+                            day,
+                            day + timedelta(days=1),
+                        )
 
-        for record in offers_records:
-            offers_list.append(Offer(**dict(record)))
+                LOGGER.info("Prices rollups of %s backfilled", day.date())
+                day += timedelta(days=1)
+
+    async def get_offers(self, product_id: int) -> List[Offer]:
+        async with self._acquire("get_offers", read_product_id=product_id) as con:
+            offers_records = await con.fetch(HOT_QUERIES["get_offers"], product_id)
+
+        with Span("db.build_offers"):
+            offers_list = [Offer(**dict(record)) for record in offers_records]
 
         return offers_list
 
-    async def get_offers_all(self, product_id: int) -> List[Offer]:
-        async with self.pg_pool.acquire() as con:
+    async def get_latest_offers_all(self) -> Dict[int, List[Offer]]:
+        # Return latest offers of all products, product ID -> offers
+
+        async with self._acquire("get_latest_offers_all") as con:
             offers_records = await con.fetch(
                 """
                     SELECT
                         id, product_id, price, items_in_stock, created_at
                     FROM
-                        offers
-                    WHERE
-                        product_id = $1
-                """,
-                product_id,
+                        latest_offers
+                    ORDER BY
+                        product_id, id
+                """
             )
 
-        offers_list = []
+        latest_offers: Dict[int, List[Offer]] = {}
 
         for record in offers_records:
-            offers_list.append(Offer(**dict(record)))
+            latest_offers.setdefault(record["product_id"], []).append(Offer(**dict(record)))
 
-        return offers_list
+        return latest_offers
+
+    async def iter_offers_all(
+        self,
+        product_id: int,
+        *,
+        from_date: Optional[datetime] = None,
+        to_date: Optional[datetime] = None,
+        after: Optional[Tuple[datetime, int]] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[Offer]:
+        # Read offers of product ordered by (created_at, id) with server-side cursor
+        # Only prefetched rows are in memory, pages continue after given (created_at, id) key
+
+        conditions = ["product_id = $1"]
+        args: List[Any] = [product_id]
+
+        if from_date:
+            args.append(from_date)
+            conditions.append(f"created_at >= ${len(args)}")
+
+        if to_date:
+            args.append(to_date)
+            conditions.append(f"created_at < ${len(args)}")
+
+        if after:
+            args.extend(after)
+            conditions.append(f"(created_at, id) > (${len(args) - 1}, ${len(args)})")
+
+        limit_clause = ""
+        if limit:
+            args.append(limit)
+            limit_clause = f"LIMIT ${len(args)}"
+
+        async with self._acquire("iter_offers_all", read_product_id=product_id) as con:
+            async with con.transaction():
+                async for record in con.cursor(
+                    f"""
+                        SELECT
+                            id, product_id, price, items_in_stock, created_at
+                        FROM
+                            offers
+                        WHERE
+                            {" AND ".join(conditions)}
+                        ORDER BY
+                            created_at, id
+                        {limit_clause}
+                    """,
+                    *args,
+                    prefetch=OFFERS_CURSOR_PREFETCH,
+                ):
+                    yield Offer(**dict(record))
 
     async def get_prices_from_to(
         self, product_id: int, from_date: datetime, to_date: datetime
     ) -> List[Price]:
 
-        async with self.pg_pool.acquire() as con:
+        async with self._acquire("get_prices_from_to", read_product_id=product_id) as con:
             prices_records = await con.fetch(
+                HOT_QUERIES["get_prices_from_to"], product_id, from_date, to_date
+            )
+
+        prices_list = []
+
+        for record in prices_records:
+            prices_list.append(Price(record["price"], record["created_at"]))
+
+        return prices_list
+
+    async def get_prices_percentage(
+        self, product_id: int, from_date: datetime, to_date: datetime
+    ) -> Optional[int]:
+        # Return rise/fall in percentage between the oldest and the newest price in date range
+        # Both prices are read from (product_id, created_at) index, None if there is no price
+
+        async with self._acquire("get_prices_percentage", read_product_id=product_id) as con:
+            percentage = await con.fetchval(
+                HOT_QUERIES["get_prices_percentage"], product_id, from_date, to_date
+            )
+
+        return int(percentage) if percentage is not None else None
+
+    async def get_prices_history(
+        self, product_id: int, from_date: datetime, to_date: datetime, bucket: timedelta
+    ) -> List[PriceBucket]:
+        # Aggregate prices from date (included) to date (excluded) into buckets of given width
+        # Buckets are aligned to unix epoch, the coarsest prices rollup which fits bucket width
+        # and dates is used instead of offers
+
+        rollup = self._prices_rollup_for(from_date, to_date, bucket)
+
+        if rollup:
+            history_sql = f"""
+                SELECT
+                    TIMESTAMP 'epoch' + floor(extract(epoch FROM bucket_start) / $4) * $4
+                        * INTERVAL '1 second' AS start,
+                    (array_agg(open_price ORDER BY open_created_at))[1] AS open_price,
+                    MIN(open_created_at) AS open_created_at,
+                    MAX(high) AS high,
+                    MIN(low) AS low,
+                    (array_agg(close_price ORDER BY close_created_at DESC))[1] AS close_price,
+                    MAX(close_created_at) AS close_created_at,
+                    SUM(prices_sum)::FLOAT / SUM(prices_count) AS avg,
+                    SUM(prices_count) AS count
+                FROM
+                    {rollup}
+                WHERE
+                    product_id = $1
+                AND
+                    bucket_start >= $2
+                AND
+                    bucket_start < $3
+                GROUP BY
+                    start
+                ORDER BY
+                    start
+            """
+        else:
+            history_sql = """
+                SELECT
+                    TIMESTAMP 'epoch' + floor(extract(epoch FROM created_at) / $4) * $4
+                        * INTERVAL '1 second' AS start,
+                    (array_agg(price ORDER BY created_at, id))[1] AS open_price,
+                    MIN(created_at) AS open_created_at,
+                    MAX(price) AS high,
+                    MIN(price) AS low,
+                    (array_agg(price ORDER BY created_at DESC, id DESC))[1] AS close_price,
+                    MAX(created_at) AS close_created_at,
+                    AVG(price)::FLOAT AS avg,
+                    COUNT(*) AS count
+                FROM
+                    offers
+                WHERE
+                    product_id = $1
+                AND
+                    created_at >= $2
+                AND
+                    created_at < $3
+                GROUP BY
+                    start
+                ORDER BY
+                    start
+            """
+
+        async with self._acquire("get_prices_history", read_product_id=product_id) as con:
+            buckets_records = await con.fetch(
+                history_sql, product_id, from_date, to_date, int(bucket.total_seconds())
+            )
+
+        buckets_list = []
+
+        for record in buckets_records:
+            buckets_list.append(
+                PriceBucket(
+                    start=record["start"],
+                    open=Price(record["open_price"], record["open_created_at"]),
+                    high=record["high"],
+                    low=record["low"],
+                    close=Price(record["close_price"], record["close_created_at"]),
+                    avg=record["avg"],
+                    count=record["count"],
+                )
+            )
+
+        return buckets_list
+
+    @staticmethod
+    def _prices_rollup_for(
+        from_date: datetime, to_date: datetime, bucket: timedelta
+    ) -> Optional[str]:
+        # Return the coarsest rollup which could be aggregated into buckets of given width
+        # Bucket width and both dates have to be aligned to buckets of rollup
+
+        epoch = datetime(1970, 1, 1)
+
+        for rollup, _, rollup_bucket in PRICES_ROLLUPS:
+            aligned = [bucket, from_date - epoch, to_date - epoch]
+            if all(not value % rollup_bucket for value in aligned):
+                return rollup
+
+        return None
+
+    async def record_product_reads(self, reads_ago: Dict[int, float]) -> None:
+        # Store last reads of products, product ID -> seconds since read
+        # Reads of not existing products are skipped, rows are locked in order of product IDs
+
+        async with self._acquire("record_product_reads") as con:
+            await con.execute(
                 """
+                    INSERT INTO
+                        product_reads (product_id, last_read_at)
                     SELECT
-                        price, created_at
+                        reads.product_id, now() - make_interval(secs => reads.read_ago)
                     FROM
-                        offers
+                        unnest($1::int[], $2::float8[]) AS reads (product_id, read_ago)
                     WHERE
-                        product_id = $1
-                    AND
-                       created_at BETWEEN $2 AND $3
+                        EXISTS (SELECT 1 FROM products WHERE products.id = reads.product_id)
+                    ORDER BY
+                        reads.product_id
+                    ON CONFLICT (product_id) DO UPDATE SET
+                        last_read_at = GREATEST(product_reads.last_read_at, EXCLUDED.last_read_at)
                 """,
-                product_id,
-                from_date,
-                to_date,
+                list(reads_ago),
+                list(reads_ago.values()),
             )
 
-        prices_list = []
+    async def pop_product_reads(self, slots_count: int, slots: Sequence[int]) -> Dict[int, float]:
+        # Take stored reads of products with product_id % slots_count in slots
+        # Return product ID -> seconds since last read
 
-        for record in prices_records:
-            prices_list.append(Price(record["price"], record["created_at"]))
+        async with self._acquire("pop_product_reads") as con:
+            reads_records = await con.fetch(
+                """
+                    DELETE FROM
+                        product_reads
+                    WHERE
+                        product_id % $1 = ANY($2::int[])
+                    RETURNING
+                        product_id, EXTRACT(EPOCH FROM now() - last_read_at)::float8 AS read_ago
+                """,
+                slots_count,
+                list(slots),
+            )
 
-        return prices_list
+        return {record["product_id"]: record["read_ago"] for record in reads_records}
+
+    async def heartbeat_refresh_replica(self, replica_id: str, lease_ttl: float) -> int:
+        # Store heartbeat of replica and forget replicas dead for long
+        # Return count of alive replicas (including given one)
+
+        async with self._acquire("heartbeat_refresh_replica") as con:
+            async with con.transaction():
+                await con.execute(
+                    """
+                        INSERT INTO
+                            refresh_replicas (replica_id, heartbeat_at)
+                        VALUES
+                            ($1, now())
+                        ON CONFLICT (replica_id) DO UPDATE SET
+                            heartbeat_at = EXCLUDED.heartbeat_at
+                    """,
+                    replica_id,
+                )
+                await con.execute(
+                    """
+                        DELETE FROM
+                            refresh_replicas
+                        WHERE
+                            heartbeat_at < now() - make_interval(secs => $1 * 10)
+                    """,
+                    lease_ttl,
+                )
+
+                alive_replicas: int = await con.fetchval(
+                    """
+                        SELECT
+                            COUNT(*)
+                        FROM
+                            refresh_replicas
+                        WHERE
+                            heartbeat_at > now() - make_interval(secs => $1)
+                    """,
+                    lease_ttl,
+                )
+
+        return alive_replicas
+
+    async def renew_refresh_leases(
+        self, replica_id: str, slots_count: int, lease_ttl: float
+    ) -> List[int]:
+        # Create missing slots, extend leases of replica and return its slots
+        # Lease already expired and claimed by other replica is lost
+
+        async with self._acquire("renew_refresh_leases") as con:
+            async with con.transaction():
+                await con.execute(
+                    """
+                        INSERT INTO
+                            refresh_leases (slot)
+                        SELECT
+                            generate_series(0, $1 - 1)
+                        ON CONFLICT DO NOTHING
+                    """,
+                    slots_count,
+                )
+
+                slots_records = await con.fetch(
+                    """
+                        UPDATE
+                            refresh_leases
+                        SET
+                            expires_at = now() + make_interval(secs => $3)
+                        WHERE
+                            owner = $1
+                        AND
+                            slot < $2
+                        RETURNING
+                            slot
+                    """,
+                    replica_id,
+                    slots_count,
+                    lease_ttl,
+                )
+
+        return sorted(slot["slot"] for slot in slots_records)
+
+    async def claim_refresh_leases(
+        self, replica_id: str, slots_count: int, lease_ttl: float, count: int
+    ) -> List[int]:
+        # Lease up to count of free slots, slots locked by other claiming replica are skipped
+        # Return newly leased slots
+
+        async with self._acquire("claim_refresh_leases") as con:
+            slots_records = await con.fetch(
+                """
+                    UPDATE
+                        refresh_leases
+                    SET
+                        owner = $1,
+                        expires_at = now() + make_interval(secs => $3)
+                    WHERE
+                        slot IN (
+                            SELECT
+                                slot
+                            FROM
+                                refresh_leases
+                            WHERE
+                                slot < $2
+                            AND
+                                (owner IS NULL OR expires_at < now())
+                            ORDER BY
+                                slot
+                            LIMIT $4
+                            FOR UPDATE SKIP LOCKED
+                        )
+                    RETURNING
+                        slot
+                """,
+                replica_id,
+                slots_count,
+                lease_ttl,
+                count,
+            )
+
+        return sorted(slot["slot"] for slot in slots_records)
+
+    async def release_refresh_leases(
+        self, replica_id: str, slots: Optional[Sequence[int]] = None
+    ) -> None:
+        # Release given leased slots of replica, all of them without slots
+
+        async with self._acquire("release_refresh_leases") as con:
+            await con.execute(
+                """
+                    UPDATE
+                        refresh_leases
+                    SET
+                        owner = NULL,
+                        expires_at = NULL
+                    WHERE
+                        owner = $1
+                    AND
+                        ($2::INT[] IS NULL OR slot = ANY($2::INT[]))
+                """,
+                replica_id,
+                None if slots is None else list(slots),
+            )
 
     async def is_connected(self) -> bool:
         try:
             # Acquire and release connection from pool - liveness check
-            async with self.pg_pool.acquire():
+            async with self._acquire("is_connected"):
                 pass
         except (ConnectionRefusedError, CannotConnectNowError, ConnectionDoesNotExistError):
             LOGGER.error("DB is not connected")
             return False
+        except DatabaseOverloaded:
+            # Busy pool is alive, restart of app would not help
+            LOGGER.warning("DB pool is busy, liveness check could not get connection")
 
         return True
 
+    async def monitor_replicas(self) -> None:
+        if self._replicas is not None:
+            await self._replicas.run()
+
+    def replicas_stats(self) -> Dict[str, Dict[str, Any]]:
+        return self._replicas.stats() if self._replicas is not None else {}
+
     async def aclose(self) -> None:
         await self.pg_pool.close()
+
+        if self._replicas is not None:
+            await self._replicas.aclose()
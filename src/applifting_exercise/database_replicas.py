@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import asyncpg
+
+from .cache import LRUCache
+from .metrics import DB_POOL_IN_USE, DB_POOL_SIZE, DB_REPLICA_LAG
+
+LOGGER = logging.getLogger(__name__)
+
+# Keys of primary pool config which are replaced by replica DSN
+CONNECTION_KEYS = ("dsn", "host", "port", "database", "user", "password")
+
+# Replication lag in seconds, replica with all received WAL replayed is not behind primary
+# NULL when replica did not replay any transaction yet, server out of recovery has no lag
+REPLICATION_LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END::float8
+"""
+
+# Count of recently written products remembered for reads from primary
+WRITTEN_PRODUCTS_SIZE = 10000
+
+# Errors of connection to replica, reads fall back to primary after them
+REPLICA_CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.InterfaceError,
+)
+
+
+@dataclass
+class Replica:
+    __slots__ = ["name", "pool", "healthy", "lag"]
+
+    name: str
+    pool: asyncpg.pool.Pool
+    healthy: bool
+    lag: Optional[float]
+
+
+def _connections_in_use(pool: asyncpg.pool.Pool) -> Callable[[], float]:
+    return lambda: pool.get_size() - pool.get_idle_size()
+
+
+class ReplicaSet:
+    # Read replicas of primary DB, reads are spread over healthy replicas round robin
+    # Replica is healthy while it answers health checks and its replication lag is under max lag
+    # Products written by this process are read from primary until replicas surely replayed
+    # the write (max lag and check interval)
+
+    def __init__(
+        self, pools: List[asyncpg.pool.Pool], replicas_config: Optional[Dict[str, Any]] = None
+    ) -> None:
+        replicas_config = replicas_config or {}
+
+        self._max_lag = float(replicas_config.get("max_lag", 5))
+        self.check_interval = float(replicas_config.get("check_interval", 2))
+        # Product rows could be read from replicas, offers and prices are read from them always
+        self.read_products = bool(replicas_config.get("read_products", True))
+        self._replicas = [Replica(f"replica{i}", pool, False, None) for i, pool in enumerate(pools)]
+        self._next_index = 0
+
+        # Products written recently, product ID -> True
+        self._written_products = LRUCache[int, bool](WRITTEN_PRODUCTS_SIZE)
+        self._read_your_writes_window = self._max_lag + self.check_interval
+
+        for replica in self._replicas:
+            DB_POOL_SIZE.set_function(replica.pool.get_size, (replica.name,))
+            DB_POOL_IN_USE.set_function(_connections_in_use(replica.pool), (replica.name,))
+
+    @classmethod
+    async def async_init(
+        cls, pool_config: Dict[str, Any], replicas_config: Dict[str, Any]
+    ) -> Optional["ReplicaSet"]:
+        # Replica pools share size and statements config of primary pool
+        # Pools do not open connections at start, unavailable replica must not prevent app start
+
+        dsns = list(replicas_config.get("dsns", []))
+        if not dsns:
+            return None
+
+        pool_config = {
+            key: value for key, value in pool_config.items() if key not in CONNECTION_KEYS
+        }
+        pool_config["min_size"] = 0
+        pools = [await asyncpg.create_pool(dsn=dsn, **pool_config) for dsn in dsns]
+
+        replica_set = cls(pools, replicas_config)
+        await replica_set.check()
+
+        return replica_set
+
+    def record_write(self, product_id: int) -> None:
+        self._written_products.set(product_id, True, self._read_your_writes_window)
+
+    def pick(self, product_id: int) -> Optional[Replica]:
+        # Return replica for read of product data, None when read must go to primary
+        try:
+            written = self._written_products[product_id]
+        except KeyError:
+            written = False
+
+        if written:
+            return None
+
+        for _ in range(len(self._replicas)):
+            replica = self._replicas[self._next_index % len(self._replicas)]
+            self._next_index += 1
+            if replica.healthy:
+                return replica
+
+        return None
+
+    def mark_unhealthy(self, replica: Replica) -> None:
+        if replica.healthy:
+            LOGGER.warning("DB %s is unhealthy, reads fall back to primary", replica.name)
+        replica.healthy = False
+
+    async def _check_replica(self, replica: Replica) -> None:
+        try:
+            async with replica.pool.acquire(timeout=self.check_interval) as con:
+                replica.lag = await con.fetchval(REPLICATION_LAG_QUERY)
+        except (*REPLICA_CONNECTION_ERRORS, asyncpg.PostgresError):
+            replica.lag = None
+            self.mark_unhealthy(replica)
+            return
+
+        if replica.lag is not None:
+            DB_REPLICA_LAG.set(replica.lag, (replica.name,))
+
+        healthy = replica.lag is not None and replica.lag <= self._max_lag
+        if not healthy:
+            self.mark_unhealthy(replica)
+        elif not replica.healthy:
+            LOGGER.info("DB %s is healthy", replica.name)
+            replica.healthy = True
+
+    async def check(self) -> None:
+        await asyncio.gather(*(self._check_replica(replica) for replica in self._replicas))
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.check()
+
+    async def aclose(self) -> None:
+        await asyncio.gather(*(replica.pool.close() for replica in self._replicas))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            replica.name: {"healthy": replica.healthy, "lag": replica.lag}
+            for replica in self._replicas
+        }
@@ -10,10 +10,66 @@ CREATE TABLE IF NOT EXISTS products(
     description TEXT
 );
 
+-- Offers are partitioned by created_at, partitions are created and dropped by Database
 CREATE TABLE IF NOT EXISTS offers(
-    id INT PRIMARY KEY,
+    id INT NOT NULL,
     product_id INT NOT NULL,
     price INT NOT NULL,
     items_in_stock INT NOT NULL,
-    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Offers of product in (created_at, id) order, pages of offers history are index range scans
+CREATE INDEX IF NOT EXISTS offers_product_id_created_at_id_idx
+    ON offers (product_id, created_at, id);
+DROP INDEX IF EXISTS offers_product_id_created_at_idx;
+
+-- Offers from the latest update of each product, replaced with every offers update
+CREATE TABLE IF NOT EXISTS latest_offers(
+    product_id INT NOT NULL,
+    id INT NOT NULL,
+    price INT NOT NULL,
+    items_in_stock INT NOT NULL,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (product_id, id)
+);
+
+-- Prices of offers aggregated per product and hour/day, updated with every offers insert
+CREATE TABLE IF NOT EXISTS prices_hourly(
+    product_id INT NOT NULL,
+    bucket_start TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    open_price INT NOT NULL,
+    open_created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    close_price INT NOT NULL,
+    close_created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    high INT NOT NULL,
+    low INT NOT NULL,
+    prices_sum BIGINT NOT NULL,
+    items_in_stock_sum BIGINT NOT NULL,
+    prices_count INT NOT NULL,
+    PRIMARY KEY (product_id, bucket_start)
+);
+
+CREATE TABLE IF NOT EXISTS prices_daily (LIKE prices_hourly INCLUDING ALL);
+
+-- Replicas of app taking part in offers refresh, replica is alive while heartbeat is fresh
+CREATE TABLE IF NOT EXISTS refresh_replicas(
+    replica_id TEXT PRIMARY KEY,
+    heartbeat_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+-- Products are split into slots by product_id % slots count, replica refreshes offers
+-- of products in slots leased by it, free slot has no owner or expired lease
+CREATE TABLE IF NOT EXISTS refresh_leases(
+    slot INT PRIMARY KEY,
+    owner TEXT,
+    expires_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Last reads of products in processes which do not refresh them, process refreshing product
+-- takes its reads during sync of refresh schedule
+CREATE TABLE IF NOT EXISTS product_reads(
+    product_id INT PRIMARY KEY,
+    last_read_at TIMESTAMP WITH TIME ZONE NOT NULL
 );
@@ -16,3 +16,23 @@ class ProductIdNotInt(Exception):
 
 class ProductIdNotExists(Exception):
     pass
+
+
+class PricesNotExists(Exception):
+    pass
+
+
+class PasswordHashingOverloaded(Exception):
+    pass
+
+
+class DatabaseOverloaded(Exception):
+    pass
+
+
+class ResponseStreamInterrupted(Exception):
+    pass
+
+
+class OffersServiceCallShed(Exception):
+    pass
@@ -0,0 +1,245 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Metrics in Prometheus text exposition format, metrics are kept in process memory
+# and updated without locking (all updates run in event loop thread)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+class Metric(ABC):
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Labels = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+    @abstractmethod
+    def samples(self) -> List[Tuple[str, Labels, Labels, float]]:
+        # Return list of (sample name, label names, label values, value)
+        ...
+
+    def render(self, const_labels: Optional[Dict[str, str]] = None) -> str:
+        # Constant labels are added to all samples
+        const_labels = const_labels or {}
+        const_names = tuple(const_labels)
+        const_values = tuple(const_labels.values())
+
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        lines.extend(
+            f"{name}{_format_labels((*names, *const_names), (*values, *const_values))} "
+            f"{_format_value(value)}"
+            for name, names, values, value in self.samples()
+        )
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Labels = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), value: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self) -> List[Tuple[str, Labels, Labels, float]]:
+        return [(self.name, self.labels, labels, value) for labels, value in self._values.items()]
+
+
+class Gauge(Metric):
+    # Value is set directly or read from function when metrics are rendered
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Labels = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Labels, float] = {}
+        self._functions: Dict[Labels, Callable[[], float]] = {}
+
+    def set(self, value: float, labels: Labels = ()) -> None:
+        self._values[labels] = value
+
+    def set_function(self, function: Callable[[], float], labels: Labels = ()) -> None:
+        self._functions[labels] = function
+
+    def samples(self) -> List[Tuple[str, Labels, Labels, float]]:
+        values = {**self._values}
+        values.update((labels, function()) for labels, function in self._functions.items())
+
+        return [(self.name, self.labels, labels, value) for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Labels = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self._buckets = tuple(buckets)
+        # Labels -> (counts per bucket (not cumulative, last is +Inf), sum of values)
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        try:
+            counts, total = self._values[labels]
+        except KeyError:
+            counts, total = self._values[labels] = ([0] * (len(self._buckets) + 1), [0.0])
+
+        counts[bisect_left(self._buckets, value)] += 1
+        total[0] += value
+
+    def samples(self) -> List[Tuple[str, Labels, Labels, float]]:
+        samples: List[Tuple[str, Labels, Labels, float]] = []
+        bucket_labels = (*self.labels, "le")
+
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for upper_bound, count in zip((*self._buckets, float("inf")), counts):
+                cumulative += count
+                samples.append(
+                    (
+                        f"{self.name}_bucket",
+                        bucket_labels,
+                        (*labels, _format_value(upper_bound)),
+                        cumulative,
+                    )
+                )
+
+            samples.append((f"{self.name}_sum", self.labels, labels, total[0]))
+            samples.append((f"{self.name}_count", self.labels, labels, cumulative))
+
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: List[Metric] = []
+        # Labels of all samples, label name -> value
+        # Worker processes label their metrics by worker index, so they are distinct series
+        self.const_labels: Dict[str, str] = {}
+
+    def counter(self, name: str, documentation: str, labels: Labels = ()) -> Counter:
+        counter = Counter(name, documentation, labels)
+        self._metrics.append(counter)
+
+        return counter
+
+    def gauge(self, name: str, documentation: str, labels: Labels = ()) -> Gauge:
+        gauge = Gauge(name, documentation, labels)
+        self._metrics.append(gauge)
+
+        return gauge
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: Labels = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        histogram = Histogram(name, documentation, labels, buckets)
+        self._metrics.append(histogram)
+
+        return histogram
+
+    def render(self) -> str:
+        return "\n".join(metric.render(self.const_labels) for metric in self._metrics) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    "http_request_duration_seconds", "Duration of HTTP requests", ("route", "method", "status")
+)
+
+DB_POOL_SIZE = REGISTRY.gauge("db_pool_size", "Count of connections in DB pool", ("pool",))
+DB_POOL_IN_USE = REGISTRY.gauge(
+    "db_pool_in_use", "Count of DB pool connections in use", ("pool",)
+)
+DB_POOL_ACQUIRE_DURATION = REGISTRY.histogram(
+    "db_pool_acquire_duration_seconds", "Wait for connection from DB pool", ("pool",)
+)
+DB_REPLICA_LAG = REGISTRY.gauge(
+    "db_replica_lag_seconds", "Replication lag of DB read replica", ("pool",)
+)
+
+OFFERS_SERVICE_CALL_DURATION = REGISTRY.histogram(
+    "offers_service_call_duration_seconds", "Duration of offers service calls", ("outcome",)
+)
+OFFERS_SERVICE_ERRORS = REGISTRY.counter(
+    "offers_service_errors_total", "Failed or rejected offers service calls", ("reason",)
+)
+OFFERS_SERVICE_CONCURRENCY_LIMIT = REGISTRY.gauge(
+    "offers_service_concurrency_limit", "Adaptive limit of concurrent offers service calls"
+)
+OFFERS_SERVICE_IN_FLIGHT = REGISTRY.gauge(
+    "offers_service_in_flight", "Count of offers service calls in progress"
+)
+
+OFFERS_REFRESH_THROUGHPUT = REGISTRY.gauge(
+    "offers_refresh_products_per_second", "Products refreshed per second in the latest window"
+)
+OFFERS_WRITE_DURATION = REGISTRY.histogram(
+    "offers_write_duration_seconds", "Duration of insert of fetched offers batch"
+)
+OFFERS_REFRESHED_PRODUCTS = REGISTRY.counter(
+    "offers_refreshed_products_total", "Products with fetched offers"
+)
+OFFERS_INGESTED = REGISTRY.counter(
+    "offers_ingested_total", "Offers written to DB by refresh", ("result",)
+)
+OFFERS_REFRESH_LAG = REGISTRY.gauge(
+    "offers_refresh_lag_seconds", "Time the most overdue product waits for refresh"
+)
+
+EVENT_LOOP_LAG = REGISTRY.histogram("event_loop_lag_seconds", "Delay of event loop callbacks")
+
+
+async def monitor_event_loop_lag(interval: float = 0.5) -> None:
+    # Sleeping task wakes up late by time the event loop was blocked
+    while True:
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(time.perf_counter() - started_at - interval, 0))
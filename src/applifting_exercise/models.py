@@ -1,8 +1,12 @@
+import base64
+import json
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Dict, Union
+from datetime import datetime, timedelta
+from typing import Dict, Tuple, Union
 
-from schema import And, Schema, Use
+from schema import And
+from schema import Optional as SchemaOptional
+from schema import Schema, Use
 
 USER_REQUEST_SCHEMA = Schema(
     {
@@ -53,10 +57,42 @@ class Offer:
         return {"id": self.product_id, "price": self.price, "items_in_stock": self.items_in_stock}
 
 
+@dataclass
+class OffersInsertResult:
+    __slots__ = ["inserted", "skipped"]
+
+    inserted: int
+    skipped: int
+
+
+def encode_offers_cursor(offer: Offer) -> str:
+    # Opaque cursor pointing after given offer in offers ordered by (created_at, id)
+    cursor_json = json.dumps([offer.created_at.isoformat(), offer.id])
+
+    return base64.urlsafe_b64encode(cursor_json.encode()).decode()
+
+
+def decode_offers_cursor(cursor: str) -> Tuple[datetime, int]:
+    created_at, offer_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+    return datetime.fromisoformat(created_at), int(offer_id)
+
+
+OFFERS_ALL_QUERY_SCHEMA = Schema(
+    {
+        SchemaOptional("limit"): And(Use(int), lambda n: 0 < n <= 1000),
+        SchemaOptional("after"): Use(decode_offers_cursor),
+        SchemaOptional("from"): Use(datetime.fromisoformat),
+        SchemaOptional("to"): Use(datetime.fromisoformat),
+    }
+)
+
+
 PRICES_FROM_TO_SCHEMA = Schema(
     {
         "from_date": Use(datetime.fromisoformat),
         "to_date": Use(datetime.fromisoformat),
+        SchemaOptional("include_prices", default=True): bool,
     }
 )
 
@@ -67,3 +103,51 @@ class Price:
 
     value: int
     created_at: datetime
+
+
+PRICE_BUCKETS = {
+    "1m": timedelta(minutes=1),
+    "5m": timedelta(minutes=5),
+    "15m": timedelta(minutes=15),
+    "1h": timedelta(hours=1),
+    "6h": timedelta(hours=6),
+    "1d": timedelta(days=1),
+}
+MAX_PRICE_BUCKETS_COUNT = 10000
+
+PRICES_HISTORY_SCHEMA = And(
+    Schema(
+        {
+            "from_date": Use(datetime.fromisoformat),
+            "to_date": Use(datetime.fromisoformat),
+            "bucket": Use(PRICE_BUCKETS.__getitem__),
+        }
+    ),
+    lambda d: d["from_date"] < d["to_date"],
+    lambda d: (d["to_date"] - d["from_date"]) / d["bucket"] <= MAX_PRICE_BUCKETS_COUNT,
+)
+
+
+@dataclass
+class PriceBucket:
+    __slots__ = ["start", "open", "high", "low", "close", "avg", "count"]
+
+    start: datetime
+    open: Price
+    high: int
+    low: int
+    close: Price
+    avg: float
+    count: int
+
+    @property
+    def for_api(self) -> Dict[str, Union[str, int, float]]:
+        return {
+            "start": self.start.isoformat(),
+            "open": self.open.value,
+            "high": self.high,
+            "low": self.low,
+            "close": self.close.value,
+            "avg": round(self.avg, 2),
+            "count": self.count,
+        }
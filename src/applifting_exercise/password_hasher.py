@@ -0,0 +1,57 @@
+import asyncio
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar, Union
+
+import bcrypt
+
+from .exceptions import PasswordHashingOverloaded
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class PasswordHasher:
+    # Run bcrypt hashing and verification in worker pool instead of event loop
+    # Count of waiting and running jobs is limited, jobs over limit are rejected immediately
+
+    def __init__(self, hashing_config: Optional[Dict[str, Union[str, int]]] = None) -> None:
+        hashing_config = hashing_config or {}
+
+        executor_type = str(hashing_config.get("executor", "thread"))
+        workers = int(hashing_config.get("workers", 4))
+
+        self._executor: Executor
+        if executor_type == "thread":
+            self._executor = ThreadPoolExecutor(workers, thread_name_prefix="password_hasher")
+        elif executor_type == "process":
+            self._executor = ProcessPoolExecutor(workers)
+        else:
+            raise ValueError(f"Unsupported password hashing executor {executor_type}")
+
+        self._max_queued = int(hashing_config.get("max_queued", 32))
+        self._bcrypt_rounds = int(hashing_config.get("bcrypt_rounds", 12))
+        self._queued = 0
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        if self._queued >= self._max_queued:
+            LOGGER.warning("Password hashing pool is full (%s jobs)", self._queued)
+            raise PasswordHashingOverloaded
+
+        self._queued += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self._queued -= 1
+
+    async def hash_password(self, password: str) -> bytes:
+        salt = bcrypt.gensalt(self._bcrypt_rounds)
+
+        return await self._run(bcrypt.hashpw, password.encode(), salt)
+
+    async def check_password(self, password: str, hashed_pwd: bytes) -> bool:
+        return await self._run(bcrypt.checkpw, password.encode(), hashed_pwd)
+
+    async def aclose(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import math
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Optional
+
+import asyncpg
+
+from .database import Database
+from .exceptions import DatabaseOverloaded
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RefreshCoordinator:
+    # Split offers refresh between replicas of app - product belongs to slot
+    # product_id % slots count and every replica leases its fair share of slots in Postgres
+    # Leases are renewed by heartbeat, leases of dead replica expire and alive replicas
+    # claim them, replicas over fair share release their extra slots
+    # Without coordination enabled, replica owns all slots
+
+    def __init__(self, db: Database, coordination_config: Optional[Dict[str, Any]] = None) -> None:
+        coordination_config = coordination_config or {}
+
+        self._db = db
+        self._enabled = bool(coordination_config.get("enabled", False))
+        self._lease_ttl = float(coordination_config.get("lease_ttl", 30))
+        self._last_heartbeat_at = 0.0
+
+        self.slots_count = int(coordination_config.get("slots", 64)) if self._enabled else 1
+        self.replica_id = str(coordination_config.get("replica_id", None) or uuid.uuid4())
+        self.owned_slots: FrozenSet[int] = (
+            frozenset() if self._enabled else frozenset(range(self.slots_count))
+        )
+
+    def owns(self, product_id: int) -> bool:
+        return product_id % self.slots_count in self.owned_slots
+
+    async def _update_leases(self) -> FrozenSet[int]:
+        alive_replicas = await self._db.heartbeat_refresh_replica(self.replica_id, self._lease_ttl)
+        fair_share = math.ceil(self.slots_count / max(alive_replicas, 1))
+
+        slots = await self._db.renew_refresh_leases(
+            self.replica_id, self.slots_count, self._lease_ttl
+        )
+
+        if len(slots) > fair_share:
+            await self._db.release_refresh_leases(self.replica_id, slots[fair_share:])
+            slots = slots[:fair_share]
+        elif len(slots) < fair_share:
+            slots += await self._db.claim_refresh_leases(
+                self.replica_id, self.slots_count, self._lease_ttl, fair_share - len(slots)
+            )
+
+        return frozenset(slots)
+
+    async def run(self, slots_changed: Callable[[], Awaitable[None]]) -> None:
+        # Renew leases three times per lease TTL, slots_changed is awaited after every change
+        # of owned slots, replica without heartbeat for lease TTL gives up its slots
+
+        if not self._enabled:
+            return
+
+        while True:
+            try:
+                owned_slots = await self._update_leases()
+                self._last_heartbeat_at = time.monotonic()
+            except (asyncpg.PostgresError, OSError, DatabaseOverloaded):
+                LOGGER.exception("Renew of offers refresh leases failed")
+                owned_slots = self.owned_slots
+                if time.monotonic() - self._last_heartbeat_at > self._lease_ttl:
+                    owned_slots = frozenset()
+
+            if owned_slots != self.owned_slots:
+                LOGGER.info(
+                    "Replica %s owns %s of %s offers refresh slots",
+                    self.replica_id,
+                    len(owned_slots),
+                    self.slots_count,
+                )
+                self.owned_slots = owned_slots
+                await slots_changed()
+
+            await asyncio.sleep(self._lease_ttl / 3)
+
+    async def aclose(self) -> None:
+        # Release leases, so other replicas do not wait for their expiration
+        if self._enabled:
+            await self._db.release_refresh_leases(self.replica_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "replica_id": self.replica_id,
+            "slots": self.slots_count,
+            "owned_slots": len(self.owned_slots),
+        }
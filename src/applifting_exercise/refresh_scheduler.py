@@ -0,0 +1,174 @@
+import asyncio
+import heapq
+import logging
+import random
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds between warnings about refresh falling behind schedule
+LAG_WARNING_PERIOD = 60
+
+
+class RefreshScheduler:  # pylint: disable=too-many-instance-attributes
+    # Keep next refresh time of every product in heap, products are taken one by one when due
+    # Products read recently (hot) are refreshed more often than products not read for long (cold)
+    # Rescheduled product leaves its old entry in heap, entry is valid only while it matches
+    # product due time, so invalid entries are dropped when they get to top of heap
+
+    def __init__(self, schedule_config: Optional[Dict[str, Any]] = None) -> None:
+        schedule_config = schedule_config or {}
+
+        self._interval = float(schedule_config.get("interval", 60))
+        self._hot_interval = float(schedule_config.get("hot_interval", 30))
+        self._cold_interval = float(schedule_config.get("cold_interval", 300))
+        self._hot_window = float(schedule_config.get("hot_window", 300))
+        self._cold_after = float(schedule_config.get("cold_after", 3600))
+        self._lag_warning = float(schedule_config.get("lag_warning", 10))
+        self._interval_overrides = {
+            int(product_id): float(interval)
+            for product_id, interval in dict(schedule_config.get("interval_overrides", {})).items()
+        }
+
+        self._heap: List[Tuple[float, int]] = []
+        self._due_at: Dict[int, float] = {}
+        # Products taken for refresh, product ID -> time when it was due
+        self._in_flight: Dict[int, float] = {}
+        self._last_read_at: Dict[int, float] = {}
+        self._started_at = time.monotonic()
+        self._lag_warned_at = 0.0
+        self._changed = asyncio.Event()
+
+    def interval(self, product_id: int) -> float:
+        if product_id in self._interval_overrides:
+            return self._interval_overrides[product_id]
+
+        # Products not read since start are cold only after cold_after from start
+        read_ago = time.monotonic() - self._last_read_at.get(product_id, self._started_at)
+        if product_id in self._last_read_at and read_ago <= self._hot_window:
+            return self._hot_interval
+
+        if read_ago >= self._cold_after:
+            return self._cold_interval
+
+        return self._interval
+
+    def _schedule(self, product_id: int, due_at: float) -> None:
+        self._due_at[product_id] = due_at
+        heapq.heappush(self._heap, (due_at, product_id))
+        self._changed.set()
+
+    def _reschedule_earlier(self, product_id: int) -> None:
+        # Product waiting for refresh is moved by its new interval, it is never postponed
+        due_at = time.monotonic() + self.interval(product_id)
+        if due_at < self._due_at.get(product_id, due_at):
+            self._schedule(product_id, due_at)
+
+    def add(self, product_id: int, delay: Optional[float] = None) -> None:
+        # Product is due after delay seconds, without delay new products are spread randomly
+        # over their interval to avoid refreshing all at once
+
+        if product_id in self._due_at or product_id in self._in_flight:
+            return
+
+        if delay is None:
+            delay = random.uniform(0, self.interval(product_id))
+
+        self._schedule(product_id, time.monotonic() + delay)
+
+    def remove(self, product_id: int) -> None:
+        self._due_at.pop(product_id, None)
+        self._in_flight.pop(product_id, None)
+        self._last_read_at.pop(product_id, None)
+
+    def record_read(self, product_id: int, read_ago: float = 0) -> None:
+        # Reads of products not scheduled here (unknown IDs, products of other replicas)
+        # are not kept, so reads of random IDs do not grow scheduler state
+        # Reads in other processes are recorded later with seconds since read
+        if product_id not in self._due_at and product_id not in self._in_flight:
+            return
+
+        read_at = time.monotonic() - read_ago
+        self._last_read_at[product_id] = max(read_at, self._last_read_at.get(product_id, read_at))
+        self._reschedule_earlier(product_id)
+
+    def set_interval_override(self, product_id: int, interval: Optional[float]) -> None:
+        # Set refresh interval of product, None returns product to hot and cold intervals
+
+        if interval is None:
+            self._interval_overrides.pop(product_id, None)
+        else:
+            self._interval_overrides[product_id] = interval
+
+        self._reschedule_earlier(product_id)
+
+    def _drop_invalid_entries(self) -> None:
+        while self._heap and self._due_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _check_lag(self, lag: float, now: float) -> None:
+        if lag > self._lag_warning and now - self._lag_warned_at >= LAG_WARNING_PERIOD:
+            self._lag_warned_at = now
+            LOGGER.warning("Offers refresh is behind schedule by %.1f seconds", lag)
+
+    async def next_due(self) -> int:
+        # Wait until some product is due and return its ID
+        # Returned product is in flight until done is called
+
+        while True:
+            self._drop_invalid_entries()
+            now = time.monotonic()
+
+            if self._heap and self._heap[0][0] <= now:
+                due_at, product_id = heapq.heappop(self._heap)
+                del self._due_at[product_id]
+                self._in_flight[product_id] = due_at
+                self._check_lag(now - due_at, now)
+
+                return product_id
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def done(self, product_id: int) -> None:
+        # Schedule next refresh of product by its interval from time when it was due
+        # Product behind schedule is due again immediately, its lag is not accumulated
+
+        due_at = self._in_flight.pop(product_id, None)
+        if due_at is None:
+            return
+
+        self._schedule(product_id, max(due_at + self.interval(product_id), time.monotonic()))
+
+    async def sync(self, products_ids: AsyncIterator[int]) -> None:
+        # Add new products and remove deleted products, products_ids must be ordered
+        # Products with ID over last read ID could be created during sync, they are kept
+
+        read_products_ids = set()
+        last_product_id = 0
+
+        async for product_id in products_ids:
+            read_products_ids.add(product_id)
+            last_product_id = product_id
+            self.add(product_id)
+
+        for product_id in [*self._due_at, *self._in_flight]:
+            if product_id <= last_product_id and product_id not in read_products_ids:
+                self.remove(product_id)
+
+    def stats(self) -> Dict[str, float]:
+        # Lag is time since the most overdue product is waiting for refresh
+
+        self._drop_invalid_entries()
+        lag = max(time.monotonic() - self._heap[0][0], 0) if self._heap else 0
+
+        return {
+            "products": len(self._due_at) + len(self._in_flight),
+            "in_flight": len(self._in_flight),
+            "lag": round(lag, 3),
+        }
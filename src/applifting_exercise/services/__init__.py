@@ -1,3 +1,6 @@
+from .circuit_breaker import CircuitBreaker
+from .limiter import AdaptiveLimiter
 from .offers import OffersService
+from .retry import RetryPolicy
 
-__all__ = ["OffersService"]
+__all__ = ["AdaptiveLimiter", "CircuitBreaker", "OffersService", "RetryPolicy"]
@@ -0,0 +1,61 @@
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    # Circuit is opened after failure threshold of consecutive failed calls
+    # Open circuit rejects calls until reset timeout, then one probe call is let through
+    # (half open), successful probe closes circuit and failed probe opens it again
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_running = False
+
+        self.state = CLOSED
+
+    def allow_request(self) -> bool:
+        if self.state == CLOSED:
+            return True
+
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+            self.state = HALF_OPEN
+
+        if self.state == HALF_OPEN and not self._probe_running:
+            self._probe_running = True
+            return True
+
+        return False
+
+    def record_success(self) -> None:
+        if self.state != CLOSED:
+            LOGGER.info("Offers service circuit is closed")
+
+        self._failures = 0
+        self._probe_running = False
+        self.state = CLOSED
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._probe_running = False
+
+        if self.state == OPEN:
+            return
+
+        if self.state == HALF_OPEN or self._failures >= self._failure_threshold:
+            LOGGER.warning("Offers service circuit is opened after %s failures", self._failures)
+            self.state = OPEN
+            self._opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        # Cancelled probe says nothing about offers service, next call is let through as probe
+        self._probe_running = False
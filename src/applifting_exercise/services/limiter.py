@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import time
+from typing import Dict
+
+LOGGER = logging.getLogger(__name__)
+
+BACKOFF_RATIO = 0.5
+
+
+class AdaptiveLimiter:
+    # Concurrency limit adapted by AIMD - limit grows by one after each limit of healthy calls
+    # and it is halved when call is overloaded (429, 5xx, connection error)
+    # or slower than latency threshold, limit is kept between min and max limit
+
+    def __init__(
+        self,
+        initial_limit: int,
+        min_limit: int,
+        max_limit: int,
+        latency_threshold: float,
+    ) -> None:
+
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._latency_threshold = latency_threshold
+
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._condition = asyncio.Condition()
+        self._last_backoff_at = 0.0
+
+        self.in_flight = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, latency: float, overloaded: bool) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+
+            if overloaded or latency > self._latency_threshold:
+                self._backoff()
+            else:
+                self._limit = min(self._limit + 1 / self._limit, self._max_limit)
+
+            self._condition.notify_all()
+
+    def _backoff(self) -> None:
+        # Calls started before previous backoff could not react on it yet
+        # so limit is decreased at most once per latency threshold
+        now = time.monotonic()
+        if now - self._last_backoff_at < self._latency_threshold:
+            return
+
+        self._last_backoff_at = now
+        self._limit = max(self._limit * BACKOFF_RATIO, self._min_limit)
+        LOGGER.warning("Offers service is overloaded, concurrency limit is %s", self.limit)
+
+    def stats(self) -> Dict[str, int]:
+        return {"concurrency_limit": self.limit, "in_flight": self.in_flight}
@@ -1,54 +1,99 @@
 import asyncio
 import logging
+import time
+from collections import Counter
 from dataclasses import asdict
 from datetime import datetime
-from typing import Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
-from aiohttp import ClientError, ClientSession
+from aiohttp import ClientError, ClientResponseError, ClientSession, ClientTimeout
 
+from ..exceptions import OffersServiceCallShed
+from ..metrics import (
+    OFFERS_SERVICE_CALL_DURATION,
+    OFFERS_SERVICE_CONCURRENCY_LIMIT,
+    OFFERS_SERVICE_ERRORS,
+    OFFERS_SERVICE_IN_FLIGHT,
+)
 from ..models import Offer, Product
+from .circuit_breaker import CircuitBreaker
+from .limiter import AdaptiveLimiter
+from .retry import RetryPolicy
 
 LOGGER = logging.getLogger(__name__)
 
+CYCLE_STATS_KEYS = ["success", "retried", "timed_out", "failed", "short_circuited", "shed"]
 
-class OffersService:
+
+def is_transient_status(status: int) -> bool:
+    return status == 429 or status >= 500
+
+
+class OffersService:  # pylint: disable=too-many-instance-attributes
     def __init__(
         self,
         client_session: ClientSession,
-        auth_header: Dict[str, str],
-        offers_config: Dict[str, Union[str, int]],
+        auth_header: Optional[Dict[str, str]],
+        offers_config: Dict[str, Union[str, int, float]],
     ) -> None:
 
         self._client_session = client_session
-        self._auth_header = auth_header
+        # Without auth header service authenticates before its first call
+        self._auth_header = auth_header or {}
+        self._auth_lock = asyncio.Lock()
 
         self._offers_service_url = offers_config["offers_service_url"]
-        self._semaphore = asyncio.Semaphore(
-            int(offers_config["offers_service_concurrency"])
+        self.limiter = AdaptiveLimiter(
+            initial_limit=int(offers_config["offers_service_concurrency"]),
+            min_limit=int(offers_config.get("offers_service_concurrency_min", 1)),
+            max_limit=int(offers_config.get("offers_service_concurrency_max", 50)),
+            latency_threshold=float(offers_config.get("offers_service_latency_threshold", 2)),
+        )
+        OFFERS_SERVICE_CONCURRENCY_LIMIT.set_function(lambda: self.limiter.limit)
+        OFFERS_SERVICE_IN_FLIGHT.set_function(lambda: self.limiter.in_flight)
+        self._retry_policy = RetryPolicy(
+            timeout=float(offers_config.get("offers_service_timeout", 5)),
+            deadline=float(offers_config.get("offers_service_deadline", 15)),
+            retries=int(offers_config.get("offers_service_retries", 2)),
+            backoff=float(offers_config.get("offers_service_retry_backoff", 0.2)),
+            backoff_max=float(offers_config.get("offers_service_retry_backoff_max", 2)),
         )
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=int(offers_config.get("offers_service_circuit_failures", 5)),
+            reset_timeout=float(offers_config.get("offers_service_circuit_reset_timeout", 30)),
+        )
+
+        self._cycle_stats: "Counter[str]" = Counter()
 
-    @classmethod
-    async def async_init(
-        cls, offers_config: Dict[str, Union[str, int]]
-    ) -> "OffersService":
+    @property
+    def authenticated(self) -> bool:
+        return bool(self._auth_header)
 
-        client_session = ClientSession()
-        offers_service_url = offers_config["offers_service_url"]
+    async def authenticate(self) -> None:
+        # Get auth token for other calls, concurrent callers wait for one auth call
+        if self._auth_header:
+            return
 
-        async with client_session.post(
-            f"{offers_service_url}/auth",
-        ) as response:
-            resp = await response.json()
+        async with self._auth_lock:
+            if self._auth_header:
+                return
 
-        auth_token = str(resp["access_token"])
+            async with self._client_session.post(
+                f"{self._offers_service_url}/auth",
+                raise_for_status=True,
+                timeout=ClientTimeout(total=self._retry_policy.timeout),
+            ) as response:
+                resp = await response.json()
 
-        return cls(client_session, {"Bearer": auth_token}, offers_config)
+            self._auth_header = {"Bearer": str(resp["access_token"])}
+            LOGGER.info("Authenticated to offers service")
 
     async def register_product(self, product: Product) -> bool:
         # Try register product into offer service
         # Return True if register was successful
 
         try:
+            await self.authenticate()
             async with self._client_session.post(
                 f"{self._offers_service_url}/products/register",
                 headers=self._auth_header,
@@ -56,27 +101,117 @@ class OffersService:
                 json=asdict(product),
             ) as _:
                 pass
-        except ClientError:
+        except (ClientError, asyncio.TimeoutError):
             LOGGER.error("Register product to offers service failed")
             return False
 
         return True
 
-    async def get_offers(self, product_id: int) -> Optional[List[Offer]]:
-        get_offer_at = datetime.utcnow()
+    async def _fetch_offers(self, product_id: int, deadline: float) -> List[Dict[str, int]]:
+        # Wait for free concurrency slot is part of call deadline, call not started until
+        # deadline is shed locally and it says nothing about offers service
+        try:
+            await asyncio.wait_for(self.limiter.acquire(), deadline - time.monotonic())
+        except asyncio.TimeoutError as e:
+            raise OffersServiceCallShed from e
+
+        timeout = min(self._retry_policy.timeout, deadline - time.monotonic())
+        call_started_at = time.monotonic()
+        overloaded = True
+        outcome = "error"
 
-        async with self._semaphore:
+        try:
+            await self.authenticate()
+            async with self._client_session.get(
+                f"{self._offers_service_url}/products/{product_id}/offers",
+                headers=self._auth_header,
+                raise_for_status=True,
+                timeout=ClientTimeout(total=timeout),
+            ) as response:
+                offers_response_list: List[Dict[str, int]] = await response.json()
+            overloaded = False
+            outcome = "success"
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise
+        except ClientResponseError as e:
+            overloaded = is_transient_status(e.status)
+            outcome = str(e.status)
+            raise
+        finally:
+            call_duration = time.monotonic() - call_started_at
+            await self.limiter.release(call_duration, overloaded)
+            OFFERS_SERVICE_CALL_DURATION.observe(call_duration, (outcome,))
+            if outcome != "success":
+                OFFERS_SERVICE_ERRORS.inc((outcome,))
+
+        return offers_response_list
+
+    async def _fetch_offers_with_retries(self, product_id: int) -> Optional[List[Dict[str, int]]]:
+        # Transient errors (timeout, connection error, 429, 5xx) are retried with jittered
+        # exponential backoff until retries or call deadline run out
+        # Return None when offers could not be fetched
+
+        deadline = time.monotonic() + self._retry_policy.deadline
+        attempt = 0
+
+        while True:
             try:
-                async with self._client_session.get(
-                    f"{self._offers_service_url}/products/{product_id}/offers",
-                    headers=self._auth_header,
-                    raise_for_status=True,
-                ) as response:
-                    offers_response_list = await response.json()
+                offers_response_list = await self._fetch_offers(product_id, deadline)
+                break
+            except OffersServiceCallShed:
+                LOGGER.warning("Call to offers service waited for concurrency slot until deadline")
+                self.circuit_breaker.release_probe()
+                self._cycle_stats["shed"] += 1
+                OFFERS_SERVICE_ERRORS.inc(("shed",))
+                return None
+            except asyncio.TimeoutError:
+                self._cycle_stats["timed_out"] += 1
+                LOGGER.warning("Call to offers service timed out")
+            except ClientResponseError as e:
+                LOGGER.warning("Call to offers service failed with status %s", e.status)
+                if not is_transient_status(e.status):
+                    # Offers service is healthy, request itself is wrong
+                    self.circuit_breaker.record_success()
+                    self._cycle_stats["failed"] += 1
+                    return None
             except ClientError:
                 LOGGER.warning("Call to offers service failed")
+
+            backoff = self._retry_policy.backoff_delay(attempt)
+            attempt += 1
+
+            if attempt > self._retry_policy.retries or time.monotonic() + backoff >= deadline:
+                self.circuit_breaker.record_failure()
+                self._cycle_stats["failed"] += 1
                 return None
 
+            self._cycle_stats["retried"] += 1
+            await asyncio.sleep(backoff)
+
+        self.circuit_breaker.record_success()
+        self._cycle_stats["success"] += 1
+
+        return offers_response_list
+
+    async def get_offers(self, product_id: int) -> Optional[List[Offer]]:
+        # Return None when offers could not be fetched or circuit is open
+        get_offer_at = datetime.utcnow()
+
+        if not self.circuit_breaker.allow_request():
+            self._cycle_stats["short_circuited"] += 1
+            OFFERS_SERVICE_ERRORS.inc(("short_circuited",))
+            return None
+
+        try:
+            offers_response_list = await self._fetch_offers_with_retries(product_id)
+        except asyncio.CancelledError:
+            self.circuit_breaker.release_probe()
+            raise
+
+        if offers_response_list is None:
+            return None
+
         offers_list = [
             Offer(**offer, product_id=product_id, created_at=get_offer_at)
             for offer in offers_response_list
@@ -84,5 +219,15 @@ class OffersService:
 
         return offers_list
 
+    def pop_cycle_stats(self) -> Dict[str, int]:
+        # Return counts of calls results since previous pop
+        cycle_stats = {key: self._cycle_stats[key] for key in CYCLE_STATS_KEYS}
+        self._cycle_stats.clear()
+
+        return cycle_stats
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.limiter.stats(), "circuit": self.circuit_breaker.state}
+
     async def aclose(self) -> None:
         await self._client_session.close()
@@ -0,0 +1,18 @@
+import random
+from dataclasses import dataclass
+
+
+@dataclass
+class RetryPolicy:
+    __slots__ = ["timeout", "deadline", "retries", "backoff", "backoff_max"]
+
+    # Seconds for one attempt and for whole call including retries
+    timeout: float
+    deadline: float
+    retries: int
+    backoff: float
+    backoff_max: float
+
+    def backoff_delay(self, attempt: int) -> float:
+        # Full jitter - random delay up to exponentially growing cap
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2**attempt))
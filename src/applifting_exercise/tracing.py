@@ -0,0 +1,68 @@
+import time
+from contextvars import ContextVar, Token
+from typing import Any, Dict, List, Optional, Tuple
+
+# Spans of current request, trace is set by tracing middleware for every request
+# Outside of traced request (background tasks, disabled tracing) spans are not recorded
+
+_CURRENT_TRACE: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    def __init__(self) -> None:
+        # Span name, duration in seconds
+        self.spans: List[Tuple[str, float]] = []
+
+    def server_timing(self) -> str:
+        # Spans with same name are summed into one metric of Server-Timing header
+
+        durations: Dict[str, float] = {}
+        counts: Dict[str, int] = {}
+        for name, duration in self.spans:
+            durations[name] = durations.get(name, 0) + duration
+            counts[name] = counts.get(name, 0) + 1
+
+        metrics = []
+        for name, duration in durations.items():
+            metric = f"{name};dur={duration * 1000:.2f}"
+            if counts[name] > 1:
+                metric += f';desc="{counts[name]}x"'
+            metrics.append(metric)
+
+        return ", ".join(metrics)
+
+    def breakdown(self) -> str:
+        return ", ".join(f"{name} {duration * 1000:.2f} ms" for name, duration in self.spans)
+
+
+def start_trace() -> Tuple[Trace, Token[Optional[Trace]]]:
+    trace = Trace()
+
+    return trace, _CURRENT_TRACE.set(trace)
+
+
+def end_trace(token: Token[Optional[Trace]]) -> None:
+    _CURRENT_TRACE.reset(token)
+
+
+def add_span(name: str, duration: float) -> None:
+    trace = _CURRENT_TRACE.get()
+    if trace is not None:
+        trace.spans.append((name, duration))
+
+
+class Span:
+    # Context manager recording duration of its block as span of current trace
+
+    __slots__ = ["_name", "_started_at"]
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._started_at = 0.0
+
+    def __enter__(self) -> "Span":
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        add_span(self._name, time.perf_counter() - self._started_at)
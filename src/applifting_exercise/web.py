@@ -1,18 +1,38 @@
+import json
 import logging
 from dataclasses import asdict
 from importlib import resources
 from importlib.metadata import version
+from typing import Any, AsyncIterator, Dict, Optional, Union
 
 from aiohttp import web
 from aiohttp.web_fileresponse import FileResponse
 from aiohttp.web_request import Request
-from aiohttp.web_response import Response
+from aiohttp.web_response import Response, StreamResponse
 from aiohttp.web_urldispatcher import UrlMappingMatchInfo
 
+from .cache import LRUCache
 from .core import Core
-from .exceptions import ProductIdNotInt
-from .models import PRICES_FROM_TO_SCHEMA, PRODUCT_SCHEMA, USER_REQUEST_SCHEMA, Product
-from .web_middlewares import auth_token_validate, error_middleware
+from .exceptions import ProductIdNotInt, ResponseStreamInterrupted
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .metrics import REGISTRY
+from .models import (
+    OFFERS_ALL_QUERY_SCHEMA,
+    PRICES_FROM_TO_SCHEMA,
+    PRICES_HISTORY_SCHEMA,
+    PRODUCT_SCHEMA,
+    USER_REQUEST_SCHEMA,
+    Offer,
+    Product,
+    encode_offers_cursor,
+)
+from .tracing import Span
+from .web_middlewares import (
+    auth_token_validate,
+    error_middleware,
+    metrics_middleware,
+    tracing_middleware,
+)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,6 +42,9 @@ LOGGER = logging.getLogger(__name__)
 
 PREFIX_V1 = "/api/v1"
 
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+OFFERS_STREAM_CHUNK_SIZE = 500
+
 
 def validate_product_id(match_info: UrlMappingMatchInfo) -> int:
     try:
@@ -33,14 +56,35 @@ def validate_product_id(match_info: UrlMappingMatchInfo) -> int:
 
 
 class WebServer:
-    def __init__(self, core: Core, port: int) -> None:
+    def __init__(
+        self,
+        core: Core,
+        port: int,
+        token_cache_size: int = 1024,
+        tracing_config: Optional[Dict[str, Union[bool, float]]] = None,
+        metrics_port: Optional[int] = None,
+    ) -> None:
+
         self._core = core
         self._port = port
+        # Worker process serves its metrics also on own port, connections to port shared
+        # by workers are balanced between them and scrape would reach random worker
+        self._metrics_port = metrics_port
+        self._metrics_runner: Optional[web.AppRunner] = None
+
+        # Tracing is opt-in, without it requests have no tracing overhead
+        tracing_config = tracing_config or {}
+        middlewares = [metrics_middleware]
+        if tracing_config.get("enabled", False):
+            middlewares.append(
+                tracing_middleware(float(tracing_config.get("slow_request_threshold", 1)))
+            )
 
         self._web_app_v1 = web.Application(middlewares=[error_middleware])
         self._web_app_v1["app_internal_token"] = self._core.app_internal_token
+        self._web_app_v1["token_cache"] = LRUCache[bytes, Dict[str, Any]](token_cache_size)
 
-        self._web_app_base = web.Application()
+        self._web_app_base = web.Application(middlewares=middlewares)
 
         self._add_routes()
         self._web_app_base.add_subapp(PREFIX_V1, self._web_app_v1)
@@ -60,17 +104,31 @@ class WebServer:
             "GET", "/products/{product_id}/offers_all", self.get_offers_all
         )
         self._web_app_v1.router.add_route("GET", "/products/{product_id}/prices", self.get_prices)
+        self._web_app_v1.router.add_route(
+            "GET", "/products/{product_id}/prices_history", self.get_prices_history
+        )
 
         self._web_app_base.router.add_route("GET", "/", self.basic_info)
         self._web_app_base.router.add_route("GET", "/favicon.ico", self.favicon)
         self._web_app_base.router.add_route("GET", "/status", self.status)
+        self._web_app_base.router.add_route("GET", "/ready", self.ready)
+        self._web_app_base.router.add_route("GET", "/metrics", self.metrics)
 
-    async def start_web_server(self) -> None:
+    async def start_web_server(self, reuse_port: bool = False) -> None:
+        # With reuse_port more processes listen on the same port and kernel balances connections
         await self._runner.setup()
         LOGGER.info("Start web server with port %s", self._port)
-        site = web.TCPSite(self._runner, port=self._port)
+        site = web.TCPSite(self._runner, port=self._port, reuse_port=reuse_port)
         await site.start()
 
+        if self._metrics_port is not None:
+            metrics_app = web.Application()
+            metrics_app.router.add_route("GET", "/metrics", self.metrics)
+            self._metrics_runner = web.AppRunner(metrics_app)
+            await self._metrics_runner.setup()
+            LOGGER.info("Start metrics server with port %s", self._metrics_port)
+            await web.TCPSite(self._metrics_runner, port=self._metrics_port).start()
+
     async def register(self, request: Request) -> Response:
         data = await request.json()
         validated_user = USER_REQUEST_SCHEMA.validate(data)
@@ -105,9 +163,11 @@ class WebServer:
     async def get_product(self, request: Request) -> Response:
         product_id = validate_product_id(request.match_info)
 
-        product = await self._core.get_product(product_id)
+        with Span("core"):
+            product = await self._core.get_product(product_id)
 
-        return web.json_response(asdict(product))
+        with Span("serialize"):
+            return web.json_response(asdict(product))
 
     @auth_token_validate()
     async def update_product(self, request: Request) -> Response:
@@ -135,16 +195,105 @@ class WebServer:
     async def get_offers(self, request: Request) -> Response:
         product_id = validate_product_id(request.match_info)
 
-        offers_list = await self._core.get_offers(product_id)
+        with Span("core"):
+            offers_list = await self._core.get_offers(product_id)
+
+        with Span("serialize"):
+            return web.json_response({"offers": [offer.for_api for offer in offers_list]})
 
-        return web.json_response({"offers": [offer.for_api for offer in offers_list]})
+    async def get_offers_all(self, request: Request) -> StreamResponse:
+        # Offers are returned as json object with offers array
+        # or as NDJSON (one offer per line) when it is requested by Accept header
+        # Whole history is streamed in chunks, with limit only one page is returned
 
-    async def get_offers_all(self, request: Request) -> Response:
         product_id = validate_product_id(request.match_info)
+        query = OFFERS_ALL_QUERY_SCHEMA.validate(dict(request.query))
+        ndjson = NDJSON_CONTENT_TYPE in request.headers.get("Accept", "")
+
+        offers = self._core.iter_offers_all(
+            product_id,
+            from_date=query.get("from"),
+            to_date=query.get("to"),
+            after=query.get("after"),
+            limit=query.get("limit"),
+        )
+
+        if "limit" in query:
+            return await self._offers_page_response(request, offers, query["limit"], ndjson)
+
+        return await self._offers_stream_response(request, offers, ndjson)
+
+    @staticmethod
+    async def _offers_page_response(
+        request: Request, offers: AsyncIterator[Offer], limit: int, ndjson: bool
+    ) -> Response:
+
+        offers_page = [offer async for offer in offers]
+
+        # Full page could be followed by next one
+        next_cursor = encode_offers_cursor(offers_page[-1]) if len(offers_page) == limit else None
+
+        if not ndjson:
+            return web.json_response(
+                {"offers": [offer.for_api for offer in offers_page], "next": next_cursor}
+            )
+
+        headers = {}
+        if next_cursor:
+            next_url = request.url.update_query(after=next_cursor)
+            headers["Link"] = f'<{next_url}>; rel="next"'
+
+        return Response(
+            text="".join(f"{json.dumps(offer.for_api)}\n" for offer in offers_page),
+            content_type=NDJSON_CONTENT_TYPE,
+            headers=headers,
+        )
+
+    @staticmethod
+    async def _offers_stream_response(
+        request: Request, offers: AsyncIterator[Offer], ndjson: bool
+    ) -> StreamResponse:
+
+        # Reading of the first offer opens DB connection and cursor, so their errors are
+        # returned as error status before status and headers of stream are sent
+        offer = await anext(offers, None)
+
+        response = StreamResponse()
+        response.content_type = NDJSON_CONTENT_TYPE if ndjson else "application/json"
+        await response.prepare(request)
+
+        chunk = [] if ndjson else ['{"offers": [']
+        offers_count = 0
 
-        offers_list = await self._core.get_offers_all(product_id)
+        try:
+            while offer is not None:
+                offer_json = json.dumps(offer.for_api)
 
-        return web.json_response({"offers": [offer.for_api for offer in offers_list]})
+                if ndjson:
+                    chunk.append(f"{offer_json}\n")
+                else:
+                    chunk.append(f", {offer_json}" if offers_count else offer_json)
+
+                offers_count += 1
+                if len(chunk) >= OFFERS_STREAM_CHUNK_SIZE:
+                    await response.write("".join(chunk).encode())
+                    chunk = []
+
+                offer = await anext(offers, None)
+
+        except Exception as e:
+            # Status is already sent, client gets truncated body instead of error response
+            if request.transport is not None:
+                request.transport.close()
+            raise ResponseStreamInterrupted from e
+
+        if not ndjson:
+            chunk.append("]}")
+
+        await response.write("".join(chunk).encode())
+        await response.write_eof()
+
+        return response
 
     async def get_prices(self, request: Request) -> Response:
         product_id = validate_product_id(request.match_info)
@@ -154,11 +303,35 @@ class WebServer:
         from_date = validated_prices_date["from_date"]
         to_date = validated_prices_date["to_date"]
 
-        prices_from_to, percentage = await self._core.get_prices(product_id, from_date, to_date)
+        with Span("core"):
+            prices_from_to, percentage = await self._core.get_prices(
+                product_id, from_date, to_date, validated_prices_date["include_prices"]
+            )
 
-        return web.json_response(
-            {"prices": [price.value for price in prices_from_to], "percentage": percentage}
-        )
+        with Span("serialize"):
+            if prices_from_to is None:
+                return web.json_response({"percentage": percentage})
+
+            return web.json_response(
+                {"prices": [price.value for price in prices_from_to], "percentage": percentage}
+            )
+
+    async def get_prices_history(self, request: Request) -> Response:
+        product_id = validate_product_id(request.match_info)
+        data = await request.json()
+
+        validated_history = PRICES_HISTORY_SCHEMA.validate(data)
+
+        with Span("core"):
+            prices_buckets = await self._core.get_prices_history(
+                product_id,
+                validated_history["from_date"],
+                validated_history["to_date"],
+                validated_history["bucket"],
+            )
+
+        with Span("serialize"):
+            return web.json_response({"buckets": [bucket.for_api for bucket in prices_buckets]})
 
     @staticmethod
     async def basic_info(_: Request) -> Response:
@@ -183,13 +356,40 @@ class WebServer:
 
     async def status(self, _: Request) -> Response:
         # Could be used in kubernetes as liveness probe
-        # Return 200 when app is alive else 500
+        # Return 200 when app is alive else 500, body contains readiness, caches and offers stats
 
         status = 200 if await self._core.is_alive() else 500
 
-        return Response(status=status)
+        caches_stats = self._core.cache_stats()
+        caches_stats["tokens"] = self._web_app_v1["token_cache"].stats()
+
+        return web.json_response(
+            {
+                "ready": self._core.is_ready(),
+                "caches": caches_stats,
+                "offers_service": self._core.offers_service_stats(),
+                "offers_refresh": self._core.offers_refresh_stats(),
+                "database": self._core.database_stats(),
+            },
+            status=status,
+        )
+
+    async def ready(self, _: Request) -> Response:
+        # Could be used in kubernetes as readiness probe, return 503 until app is ready
+        ready = self._core.is_ready()
+
+        return web.json_response({"ready": ready}, status=200 if ready else 503)
+
+    async def metrics(self, _: Request) -> Response:
+        # Metrics for Prometheus scraping
+        return web.Response(
+            body=REGISTRY.render().encode(), headers={"Content-Type": METRICS_CONTENT_TYPE}
+        )
 
     async def aclose(self) -> None:
         LOGGER.info("Closing web server")
         await self._runner.shutdown()
         await self._runner.cleanup()
+
+        if self._metrics_runner:
+            await self._metrics_runner.cleanup()
@@ -1,21 +1,30 @@
+import hashlib
 import logging
+import time
 from functools import wraps
 from json import JSONDecodeError
-from typing import TYPE_CHECKING, Any, Callable
+from typing import TYPE_CHECKING, Any, Callable, Dict
 
 from aiohttp import web
 from aiohttp.web_request import Request
-from aiohttp.web_response import Response
+from aiohttp.web_response import Response, StreamResponse
 from jose import JWTError, jwt
 from schema import SchemaError
 
+from .cache import LRUCache
 from .exceptions import (
+    DatabaseOverloaded,
     InvalidPassword,
     NewUserIsAlreadyExists,
+    PasswordHashingOverloaded,
+    PricesNotExists,
     ProductIdNotExists,
     ProductIdNotInt,
+    ResponseStreamInterrupted,
     UserIsNotExists,
 )
+from .metrics import HTTP_REQUEST_DURATION
+from .tracing import add_span, end_trace, start_trace
 
 if TYPE_CHECKING:
     from .web import WebServer
@@ -33,6 +42,10 @@ async def error_middleware(request: Request, handler: Callable[..., Any]) -> Res
     try:
         response: Response = await handler(request)
 
+    except ResponseStreamInterrupted:
+        # Streamed response has status already sent, there is no error response to send
+        raise
+
     except JSONDecodeError:
         err_msg = "JSON data required"
         LOGGER.exception(err_msg)
@@ -57,6 +70,16 @@ async def error_middleware(request: Request, handler: Callable[..., Any]) -> Res
         LOGGER.exception(err_msg)
         return web.json_response({"error": err_msg}, status=404)
 
+    except PricesNotExists:
+        err_msg = "No prices found in given date range"
+        LOGGER.exception(err_msg)
+        return web.json_response({"error": err_msg}, status=404)
+
+    except (PasswordHashingOverloaded, DatabaseOverloaded):
+        err_msg = "Server is overloaded, try it again later"
+        LOGGER.warning(err_msg)
+        return web.json_response({"error": err_msg}, status=503, headers={"Retry-After": "1"})
+
     except Exception:  # pylint: disable=broad-except
         err_msg = "Server got itself in trouble"
         LOGGER.exception(err_msg)
@@ -65,6 +88,62 @@ async def error_middleware(request: Request, handler: Callable[..., Any]) -> Res
     return response
 
 
+@web.middleware
+async def metrics_middleware(request: Request, handler: Callable[..., Any]) -> Response:
+    # Observe duration of every request labeled by route pattern (not by path with IDs)
+    request_started_at = time.perf_counter()
+    status = 500
+
+    try:
+        response: Response = await handler(request)
+        status = response.status
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource else "unmatched"
+        HTTP_REQUEST_DURATION.observe(
+            time.perf_counter() - request_started_at, (route, request.method, str(status))
+        )
+
+    return response
+
+
+def tracing_middleware(slow_request_threshold: float) -> Callable[..., Any]:
+    # Record spans of request and return them in Server-Timing header
+    # Requests slower than threshold (seconds) are logged with all their spans
+
+    @web.middleware
+    async def middleware(request: Request, handler: Callable[..., Any]) -> StreamResponse:
+        trace, token = start_trace()
+        request_started_at = time.perf_counter()
+
+        try:
+            response: StreamResponse = await handler(request)
+        finally:
+            duration = time.perf_counter() - request_started_at
+            add_span("total", duration)
+            end_trace(token)
+
+            if duration > slow_request_threshold:
+                LOGGER.warning(
+                    "Slow request %s %s %.2f ms: %s",
+                    request.method,
+                    request.path,
+                    duration * 1000,
+                    trace.breakdown(),
+                )
+
+        # Headers of streamed response are already sent
+        if not response.prepared:
+            response.headers["Server-Timing"] = trace.server_timing()
+
+        return response
+
+    return middleware
+
+
 @web.middleware
 def auth_token_validate() -> Callable[..., Any]:
     # Decorator use for route handlers which should be protected by jwt token
@@ -88,13 +167,23 @@ def auth_token_validate() -> Callable[..., Any]:
                     status=401,
                 )
 
+            # Already verified tokens are cached until their expiration
+            token_cache: LRUCache[bytes, Dict[str, Any]] = request.app["token_cache"]
+            token_digest = hashlib.sha256(authorization_token.encode()).digest()
+
             try:
-                internal_token = request.app["app_internal_token"]
-                result = jwt.decode(authorization_token, internal_token, algorithms="HS256")
-                LOGGER.info("User %s is authorized" % result["username"])
-            except JWTError as e:
-                LOGGER.exception("JWT decode failed")
-                return web.Response(text=str(e), status=401)
+                token_cache[token_digest]
+            except KeyError:
+                try:
+                    internal_token = request.app["app_internal_token"]
+                    result = jwt.decode(authorization_token, internal_token, algorithms="HS256")
+                    LOGGER.debug("User %s is authorized", result["username"])
+                except JWTError as e:
+                    LOGGER.exception("JWT decode failed")
+                    return web.Response(text=str(e), status=401)
+
+                if "exp" in result:
+                    token_cache.set(token_digest, result, result["exp"] - time.time())
 
             return await func(web_server_instance, request)
 
@@ -0,0 +1,100 @@
+import logging
+import multiprocessing
+import signal
+import time
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+from types import FrameType
+from typing import Callable, Dict, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds before crashed worker is started again, protects against fast restart loop
+RESTART_DELAY = 1
+# Seconds for workers to finish requests in progress after SIGTERM, then they are killed
+SHUTDOWN_TIMEOUT = 75
+
+
+class Supervisor:
+    # Run worker processes sharing web port and start crashed workers again
+    # SIGINT or SIGTERM of supervisor stops all workers gracefully by SIGTERM
+    # Workers are spawned (not forked), so they do not inherit state of supervisor process
+
+    def __init__(self, workers: int, worker_target: Callable[[int, int], None]) -> None:
+        self._workers = workers
+        self._worker_target = worker_target
+        self._context = multiprocessing.get_context("spawn")
+
+        self._processes: Dict[int, BaseProcess] = {}
+        # Crashed workers, worker index -> time of restart
+        self._restart_at: Dict[int, float] = {}
+        self._stopping = False
+
+    def _start_worker(self, worker_index: int) -> None:
+        process = self._context.Process(
+            target=self._worker_target,
+            args=(worker_index, self._workers),
+            name=f"worker-{worker_index}",
+        )
+        process.start()
+        self._processes[worker_index] = process
+        LOGGER.info("Worker %s started with PID %s", worker_index, process.pid)
+
+    def stop(self, signum: int, _: Optional[FrameType]) -> None:
+        LOGGER.info("Stop workers after %s", signal.Signals(signum).name)
+        self._stopping = True
+
+    def _restart_crashed_workers(self) -> None:
+        now = time.monotonic()
+
+        for worker_index, process in self._processes.items():
+            if process.is_alive():
+                continue
+
+            if worker_index not in self._restart_at:
+                LOGGER.error(
+                    "Worker %s exited with code %s, it is restarted in %s seconds",
+                    worker_index,
+                    process.exitcode,
+                    RESTART_DELAY,
+                )
+                self._restart_at[worker_index] = now + RESTART_DELAY
+
+        for worker_index, restart_at in list(self._restart_at.items()):
+            if restart_at <= now:
+                del self._restart_at[worker_index]
+                self._start_worker(worker_index)
+
+    def _stop_workers(self) -> None:
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for worker_index, process in self._processes.items():
+            process.join(max(deadline - time.monotonic(), 0))
+
+            if process.is_alive():
+                LOGGER.warning("Worker %s did not stop in time, it is killed", worker_index)
+                process.kill()
+                process.join()
+
+        LOGGER.info("All workers stopped")
+
+    def run(self) -> None:
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        for worker_index in range(self._workers):
+            self._start_worker(worker_index)
+
+        while not self._stopping:
+            # Wake up when some worker exits or restart of crashed worker is due
+            wait(
+                [process.sentinel for process in self._processes.values() if process.is_alive()],
+                timeout=RESTART_DELAY,
+            )
+            if not self._stopping:
+                self._restart_crashed_workers()
+
+        self._stop_workers()
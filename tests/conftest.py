@@ -6,7 +6,6 @@ from asyncio.events import AbstractEventLoop
 from datetime import datetime, timedelta
 from typing import AsyncGenerator, Generator
 
-import asyncpg
 import bcrypt
 import pytest
 import tenacity
@@ -71,11 +70,10 @@ async def test_db(postgres_dsn: str) -> AsyncGenerator[Database, None]:
             )
         ),
     )
-    async def connect_pg_pool() -> asyncpg.pool.Pool:
-        return await asyncpg.create_pool(dsn=postgres_dsn)
+    async def connect_database() -> Database:
+        return await Database.async_init({"dsn": postgres_dsn, "acquire_timeout": 5})
 
-    pg_pool = await connect_pg_pool()
-    database = Database(pg_pool)
+    database = await connect_database()
     await database.ensure_schema()
     yield database
     await database.aclose()
@@ -87,6 +85,12 @@ async def drop_db_tables(test_db: Database) -> None:
         await con.execute("DROP TABLE users")
         await con.execute("DROP TABLE products")
         await con.execute("DROP TABLE offers")
+        await con.execute("DROP TABLE latest_offers")
+        await con.execute("DROP TABLE prices_hourly")
+        await con.execute("DROP TABLE prices_daily")
+        await con.execute("DROP TABLE refresh_replicas")
+        await con.execute("DROP TABLE refresh_leases")
+        await con.execute("DROP TABLE product_reads")
 
     await test_db.ensure_schema()
 
@@ -1,9 +1,16 @@
-# pylint: disable=unused-argument
+# pylint: disable=unused-argument, protected-access
 
 from datetime import timedelta
 
+import pytest
 from aiohttp import ClientSession
+from applifting_exercise.core import Core
 from applifting_exercise.database import Database
+from applifting_exercise.exceptions import DatabaseOverloaded
+from applifting_exercise.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from applifting_exercise.metrics import DB_POOL_ACQUIRE_DURATION, Histogram, Metric
+from applifting_exercise.services import OffersService
+from applifting_exercise.web import PREFIX_V1, WebServer
 from freezegun.api import FrozenDateTimeFactory
 
 
@@ -17,6 +24,207 @@ async def test_status(test_web_server: None, api_url_base: str) -> None:
     async with ClientSession() as session:
         async with session.get(f"{api_url_base}/status") as response:
             assert response.status == 200
+            status_json = await response.json()
+
+        async with session.get(f"{api_url_base}/ready") as response:
+            assert response.status == 200
+            assert await response.json() == {"ready": True}
+
+    assert status_json["ready"]
+    assert set(status_json["caches"]) == {"products", "tokens"}
+    assert set(status_json["offers_service"]) == {
+        "concurrency_limit",
+        "in_flight",
+        "circuit",
+        "last_cycle",
+    }
+    assert set(status_json["offers_refresh"]) == {
+        "products",
+        "in_flight",
+        "lag",
+        "replica_id",
+        "slots",
+        "owned_slots",
+    }
+    assert status_json["database"] == {"replicas": {}}
+
+
+async def test_metrics(test_web_server: None, api_url_base: str, api_url_v1: str) -> None:
+    # Testing DB is not prepared, product ID 0 is never created
+    async with ClientSession() as session:
+        async with session.get(f"{api_url_v1}/products/0") as response:
+            assert response.status == 404
+
+        async with session.get(f"{api_url_base}/metrics") as response:
+            assert response.status == 200
+            assert response.headers["Content-Type"] == METRICS_CONTENT_TYPE
+            metrics = await response.text()
+
+    assert (
+        'http_request_duration_seconds_count{route="/api/v1/products/{product_id}",'
+        'method="GET",status="404"}'
+    ) in metrics
+    assert 'db_pool_size{pool="primary"}' in metrics
+    assert "# TYPE offers_service_call_duration_seconds histogram" in metrics
+    assert "\noffers_service_concurrency_limit " in metrics
+    assert "\noffers_service_in_flight " in metrics
+
+
+async def test_server_timing(
+    offers_service: OffersService, prepared_db: Database, caplog: pytest.LogCaptureFixture
+) -> None:
+    core = Core(offers_service=offers_service, db=prepared_db, app_internal_token="")
+    web_server = WebServer(
+        core, 8081, tracing_config={"enabled": True, "slow_request_threshold": 0}
+    )
+    await web_server.start_web_server()
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    async with ClientSession() as session:
+        async with session.get(
+            f"http://localhost:8081{PREFIX_V1}/products/{product_id}/offers"
+        ) as response:
+            assert response.status == 200
+            server_timing = response.headers["Server-Timing"]
+
+    await web_server.aclose()
+
+    spans = [metric.split(";")[0] for metric in server_timing.split(", ")]
+    assert spans == ["db.acquire", "db.get_offers", "db.build_offers", "core", "serialize", "total"]
+    assert "Slow request GET" in caplog.text
+
+
+async def test_database_acquire_timeout(postgres_dsn: str) -> None:
+    database = await Database.async_init(
+        {"dsn": postgres_dsn, "min_size": 1, "max_size": 1, "acquire_timeout": 0.1}
+    )
+
+    # The only connection is taken, next acquire fails fast
+    async with database.pg_pool.acquire():
+        with pytest.raises(DatabaseOverloaded):
+            await database.get_product(1)
+
+    await database.aclose()
+
+
+async def test_database_busy_is_connected(postgres_dsn: str) -> None:
+    database = await Database.async_init(
+        {"dsn": postgres_dsn, "min_size": 1, "max_size": 1, "acquire_timeout": 0.1}
+    )
+
+    # Busy pool without free connection is still alive for liveness probe
+    async with database.pg_pool.acquire():
+        assert await database.is_connected()
+
+    await database.aclose()
+
+
+async def test_database_replicas(test_db: Database, postgres_dsn: str) -> None:
+    def acquires_count(pool_name: str) -> float:
+        return sum(
+            value
+            for name, _, labels, value in DB_POOL_ACQUIRE_DURATION.samples()
+            if name.endswith("_count") and labels == (pool_name,)
+        )
+
+    # Primary used as replica has no replication lag, second replica is unreachable
+    database = await Database.async_init(
+        {
+            "dsn": postgres_dsn,
+            "replicas": {"dsns": [postgres_dsn, "postgresql://postgres@127.0.0.1:1/postgres"]},
+        }
+    )
+    assert database.replicas_stats() == {
+        "replica0": {"healthy": True, "lag": 0},
+        "replica1": {"healthy": False, "lag": None},
+    }
+
+    product = await database.create_product("Replica", "Read your writes")
+    primary_acquires, replica_acquires = acquires_count("primary"), acquires_count("replica0")
+
+    # Just written product is read from primary, other products from healthy replica
+    assert await database.get_product(product.id) == product
+    assert acquires_count("primary") == primary_acquires + 1
+
+    assert await database.get_offers(product.id + 1) == []
+    assert await database.get_offers(product.id + 2) == []
+    assert acquires_count("replica0") == replica_acquires + 2
+    assert acquires_count("primary") == primary_acquires + 1
+
+    await database.delete_product(product.id)
+    await database.aclose()
+
+
+async def test_database_replica_acquire_timeout(postgres_dsn: str) -> None:
+    database = await Database.async_init(
+        {
+            "dsn": postgres_dsn,
+            "min_size": 1,
+            "max_size": 1,
+            "acquire_timeout": 0.1,
+            "replicas": {"dsns": [postgres_dsn]},
+        }
+    )
+    assert database._replicas is not None
+    replica_pool = database._replicas._replicas[0].pool
+
+    # Replica without free connection is marked unhealthy and read falls back to primary
+    async with replica_pool.acquire():
+        assert await database.get_offers(1) == []
+
+    assert database.replicas_stats() == {"replica0": {"healthy": False, "lag": 0}}
+
+    await database.aclose()
+
+
+async def test_database_replica_read_products_disabled(postgres_dsn: str) -> None:
+    database = await Database.async_init(
+        {
+            "dsn": postgres_dsn,
+            "min_size": 1,
+            "max_size": 1,
+            "acquire_timeout": 0.1,
+            "replicas": {"dsns": [postgres_dsn], "read_products": False},
+        }
+    )
+    assert database._replicas is not None
+    replica_pool = database._replicas._replicas[0].pool
+
+    # Product is read from primary, replica without free connection is not used
+    async with replica_pool.acquire():
+        assert await database.get_product(0) is None
+
+    assert database.replicas_stats() == {"replica0": {"healthy": True, "lag": 0}}
+
+    await database.aclose()
+
+
+def test_histogram_render() -> None:
+    histogram = Histogram("test_seconds", "Test histogram", ("route",), buckets=(0.1, 1))
+    histogram.observe(0.05, ("/a",))
+    histogram.observe(0.5, ("/a",))
+    histogram.observe(5, ("/a",))
+
+    assert histogram.render().splitlines() == [
+        "# HELP test_seconds Test histogram",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1"} 2',
+        'test_seconds_bucket{route="/a",le="+Inf"} 3',
+        'test_seconds_sum{route="/a"} 5.55',
+        'test_seconds_count{route="/a"} 3',
+    ]
+
+
+def test_metric_without_samples() -> None:
+    class IncompleteMetric(Metric):  # pylint: disable=abstract-method
+        pass
+
+    # Metric without samples fails when it is created, not when metrics are rendered
+    with pytest.raises(TypeError):
+        # pylint: disable-next=abstract-class-instantiated
+        IncompleteMetric("test_total", "Test metric")  # type: ignore
 
 
 async def test_invalid_token(test_web_server: None, api_url_v1: str) -> None:
@@ -59,3 +267,31 @@ async def test_invalid_body(
             headers={"Authorization": f"Bearer {jwt_testing_token}"},
         ) as response:
             assert response.status == 400
+
+
+async def test_cached_token_expired(
+    prepared_db: Database, test_web_server: None, api_url_v1: str, freezer: FrozenDateTimeFactory
+) -> None:
+    json_data = {"username": "Username", "password": "TestPWD123456"}
+    product_json = {"name": "Product Name", "description": "Product Description"}
+
+    async with ClientSession() as session:
+        async with session.post(f"{api_url_v1}/login", json=json_data) as response:
+            assert response.status == 200
+            test_res_login = await response.json()
+
+        headers = {"Authorization": f"Bearer {test_res_login['token']}"}
+
+        # Verified token is cached, product 100 does not exist
+        async with session.put(
+            f"{api_url_v1}/products/100", json=product_json, headers=headers
+        ) as response:
+            assert response.status == 404
+
+        # Cached token has to expire same as not cached one
+        freezer.tick(timedelta(hours=2))
+
+        async with session.put(
+            f"{api_url_v1}/products/100", json=product_json, headers=headers
+        ) as response:
+            assert response.status == 401
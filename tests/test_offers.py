@@ -1,14 +1,22 @@
 # pylint: disable=unused-argument, protected-access
 
+import asyncio
+import json
+import time
 from datetime import datetime, timedelta
+from typing import List, Optional, Union
+
+import pytest
 
 from aiohttp import ClientSession
 from aioresponses import aioresponses
 from applifting_exercise.core import Core
 from applifting_exercise.database import Database
 from applifting_exercise.models import Offer
-from applifting_exercise.services import OffersService
+from applifting_exercise.services import AdaptiveLimiter, OffersService
+from applifting_exercise.web import PREFIX_V1, WebServer
 from freezegun.api import FrozenDateTimeFactory
+from yarl import URL
 
 
 async def test_get_offers(prepared_db: Database, test_web_server: None, api_url_v1: str) -> None:
@@ -30,6 +38,24 @@ async def test_get_offers(prepared_db: Database, test_web_server: None, api_url_
     assert offers_json == {"offers": [{"id": 1, "items_in_stock": 10, "price": 200}]}
 
 
+async def test_get_offers_replaced_by_newer(prepared_db: Database) -> None:
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+    created_at = datetime.utcnow()
+
+    offer_1 = Offer(1, product_id, 100, 5, created_at)
+    offer_2 = Offer(2, product_id, 200, 10, created_at + timedelta(minutes=1))
+    offer_3 = Offer(3, product_id, 300, 15, created_at - timedelta(minutes=1))
+
+    await prepared_db.insert_new_offers([offer_1])
+    await prepared_db.insert_new_offers([offer_2])
+
+    # Older offers should not replace the latest ones
+    await prepared_db.insert_new_offers([offer_3])
+
+    assert await prepared_db.get_offers(product_id) == [offer_2]
+
+
 async def test_get_offers_all(
     prepared_db: Database, test_web_server: None, api_url_v1: str
 ) -> None:
@@ -56,6 +82,168 @@ async def test_get_offers_all(
     }
 
 
+async def test_get_offers_all_ndjson(
+    prepared_db: Database, test_web_server: None, api_url_v1: str
+) -> None:
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    offer_1 = Offer(1, product_id, 100, 5, datetime.utcnow())
+    offer_2 = Offer(2, product_id, 200, 10, datetime.utcnow())
+
+    await prepared_db.insert_new_offers([offer_1, offer_2])
+
+    async with ClientSession() as session:
+        async with session.get(
+            f"{api_url_v1}/products/{product_id}/offers_all",
+            headers={"Accept": "application/x-ndjson"},
+        ) as response:
+            assert response.status == 200
+            assert response.content_type == "application/x-ndjson"
+            offers_lines = [json.loads(line) async for line in response.content]
+
+    assert offers_lines == [
+        {"id": 1, "items_in_stock": 5, "price": 100},
+        {"id": 1, "items_in_stock": 10, "price": 200},
+    ]
+
+
+async def test_get_offers_all_pages(
+    prepared_db: Database, test_web_server: None, api_url_v1: str
+) -> None:
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    created_at = datetime.fromisoformat("2022-04-21T10:00:00")
+    offers = [
+        Offer(offer_id, product_id, offer_id * 100, 5, created_at + timedelta(hours=offer_id))
+        for offer_id in range(1, 6)
+    ]
+
+    await prepared_db.insert_new_offers(offers)
+
+    offers_url = f"{api_url_v1}/products/{product_id}/offers_all"
+    query = {"limit": "2", "from": "2022-04-21T11:00:00", "to": "2022-04-21T15:00:00"}
+    pages_prices = []
+
+    async with ClientSession() as session:
+        while True:
+            async with session.get(offers_url, params=query) as response:
+                assert response.status == 200
+                page_json = await response.json()
+
+            pages_prices.append([offer["price"] for offer in page_json["offers"]])
+            if not page_json["next"]:
+                break
+
+            query["after"] = page_json["next"]
+
+        async with session.get(offers_url, params={"after": "invalid"}) as response:
+            assert response.status == 400
+
+    # Offers from 11:00 (included) to 15:00 (excluded)
+    assert pages_prices == [[100, 200], [300, 400], []]
+
+
+async def test_offers_pages_index(prepared_db: Database) -> None:
+    async with prepared_db.pg_pool.acquire() as con:
+        indexes = await con.fetch("SELECT indexdef FROM pg_indexes WHERE tablename = 'offers'")
+
+    # Keyset pages of offers history ordered by (created_at, id) are index range scans
+    assert [
+        index["indexdef"]
+        for index in indexes
+        if index["indexdef"].endswith("(product_id, created_at, id)")
+    ]
+    assert len(indexes) == 2
+
+
+async def test_get_offers_all_database_overloaded(
+    offers_service: OffersService, postgres_dsn: str
+) -> None:
+    database = await Database.async_init(
+        {"dsn": postgres_dsn, "min_size": 1, "max_size": 1, "acquire_timeout": 0.1}
+    )
+    core = Core(offers_service=offers_service, db=database, app_internal_token="")
+    web_server = WebServer(core, 8081)
+    await web_server.start_web_server()
+
+    # Stream is not started when DB connection could not be acquired
+    async with database.pg_pool.acquire():
+        async with ClientSession() as session:
+            async with session.get(
+                f"http://localhost:8081{PREFIX_V1}/products/1/offers_all"
+            ) as response:
+                assert response.status == 503
+
+    await web_server.aclose()
+    await database.aclose()
+
+
+async def test_insert_new_offers_duplicates(prepared_db: Database) -> None:
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    offer_1 = Offer(1, product_id, 100, 5, datetime.utcnow())
+    offer_2 = Offer(2, product_id, 200, 10, datetime.utcnow())
+
+    insert_result = await prepared_db.insert_new_offers([offer_1, offer_2])
+    assert (insert_result.inserted, insert_result.skipped) == (2, 0)
+
+    offer_3 = Offer(3, product_id, 300, 15, datetime.utcnow())
+
+    insert_result = await prepared_db.insert_new_offers([offer_1, offer_2, offer_3])
+    assert (insert_result.inserted, insert_result.skipped) == (1, 2)
+
+
+async def test_insert_new_offers_unchanged(prepared_db: Database) -> None:
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+    fetched_at = datetime.fromisoformat("2022-04-21T10:00:00")
+
+    offer_1 = Offer(1, product_id, 100, 5, fetched_at)
+    offer_2 = Offer(2, product_id, 200, 10, fetched_at)
+    await prepared_db.insert_new_offers([offer_1, offer_2])
+
+    # Refetched offers without change of price and items in stock are not stored again,
+    # neither against latest offers nor against earlier fetch in the same batch
+    offers = [
+        Offer(1, product_id, 100, 5, fetched_at + timedelta(minutes=1)),
+        Offer(2, product_id, 250, 10, fetched_at + timedelta(minutes=1)),
+        Offer(1, product_id, 100, 5, fetched_at + timedelta(minutes=2)),
+        Offer(2, product_id, 250, 10, fetched_at + timedelta(minutes=2)),
+    ]
+    insert_result = await prepared_db.insert_new_offers(offers)
+    assert (insert_result.inserted, insert_result.skipped) == (1, 3)
+
+    assert [
+        (offer.id, offer.price) async for offer in prepared_db.iter_offers_all(product_id)
+    ] == [(1, 100), (2, 200), (2, 250)]
+    assert await prepared_db.get_offers(product_id) == offers[2:]
+
+
+async def test_maintain_offers_partitions(prepared_db: Database) -> None:
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    old_offer = Offer(1, product_id, 100, 5, datetime.fromisoformat("2022-04-21T11:00:00"))
+    new_offer = Offer(2, product_id, 200, 10, datetime.utcnow())
+
+    await prepared_db.insert_new_offers([old_offer, new_offer])
+    await prepared_db.maintain_offers_partitions()
+
+    # Partition with old offer is out of retention and dropped
+    assert [offer async for offer in prepared_db.iter_offers_all(product_id)] == [new_offer]
+
+    async with prepared_db.pg_pool.acquire() as con:
+        partitions_count = await con.fetchval(
+            "SELECT COUNT(*) FROM pg_inherits WHERE inhparent = 'offers'::regclass"
+        )
+
+    # Partition for today and partitions created ahead
+    assert partitions_count == 4
+
+
 async def test_update_offers(
     offers_service: OffersService, prepared_db: Database, freezer: FrozenDateTimeFactory
 ) -> None:
@@ -71,8 +259,382 @@ async def test_update_offers(
 
         await core._update_offers()
 
-    all_offers = await prepared_db.get_offers_all(product_id)
+    all_offers = [offer async for offer in prepared_db.iter_offers_all(product_id)]
 
     assert all_offers == [
         Offer(id=100, product_id=1, price=1000, items_in_stock=5, created_at=datetime.utcnow())
     ]
+
+    # Current offers are served from snapshot without DB
+    async with prepared_db.pg_pool.acquire() as con:
+        await con.execute("TRUNCATE latest_offers")
+
+    assert await core.get_offers(product_id) == all_offers
+
+
+async def test_update_offers_batches(
+    offers_service: OffersService, prepared_db: Database, freezer: FrozenDateTimeFactory
+) -> None:
+    core = Core(
+        offers_service=offers_service,
+        db=prepared_db,
+        app_internal_token="",
+        offers_refresh_config={
+            "products_batch_size": 2,
+            "fetchers": 2,
+            "queue_size": 1,
+            "batch_size": 2,
+        },
+    )
+
+    products_ids = [
+        (await prepared_db.create_product(f"Product {index}", "Product Description")).id
+        for index in range(5)
+    ]
+
+    with aioresponses(passthrough=["http://localhost:"]) as mocked_aio_response:  # type: ignore
+        for product_id in products_ids:
+            mocked_aio_response.get(
+                f"https://test-offers.com/api/v1/products/{product_id}/offers",
+                payload=[{"id": product_id, "price": 1000, "items_in_stock": 5}],
+            )
+
+        await core._update_offers()
+
+    # Every product is written in one of batches and added to snapshot
+    for product_id in products_ids:
+        offers = [Offer(product_id, product_id, 1000, 5, datetime.utcnow())]
+        assert [offer async for offer in prepared_db.iter_offers_all(product_id)] == offers
+        assert core._offers_snapshot[product_id] == offers
+
+
+async def test_write_offers_same_product(
+    offers_service: OffersService, prepared_db: Database
+) -> None:
+    core = Core(offers_service=offers_service, db=prepared_db, app_internal_token="")
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    offer_1 = Offer(1, product_id, 100, 5, datetime.utcnow() - timedelta(minutes=1))
+    offer_2 = Offer(1, product_id, 200, 10, datetime.utcnow())
+
+    offers_queue: "asyncio.Queue[Optional[List[Offer]]]" = asyncio.Queue()
+    for offers in ([offer_1], [offer_2], None):
+        offers_queue.put_nowait(offers)
+
+    await core._write_offers(offers_queue)
+
+    # Both fetches of product in one batch are in history, snapshot has the latest one
+    assert [offer async for offer in prepared_db.iter_offers_all(product_id)] == [offer_1, offer_2]
+    assert core._offers_snapshot[product_id] == [offer_2]
+
+    window_stats = core._pop_refresh_window_stats()
+    assert (window_stats["inserted"], window_stats["skipped"]) == (2, 0)
+
+
+async def test_load_offers_snapshot(offers_service: OffersService, prepared_db: Database) -> None:
+    core = Core(offers_service=offers_service, db=prepared_db, app_internal_token="")
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    created_at = datetime.utcnow()
+    offer_1 = Offer(1, product_id, 100, 5, created_at)
+    offer_2 = Offer(2, product_id, 200, 10, created_at)
+
+    await prepared_db.insert_new_offers([offer_1, offer_2])
+    await core.load_offers_snapshot()
+
+    assert core._offers_snapshot == {product_id: [offer_1, offer_2]}
+
+
+async def test_refresh_slots_changed(offers_service: OffersService, prepared_db: Database) -> None:
+    core = Core(
+        offers_service=offers_service,
+        db=prepared_db,
+        app_internal_token="",
+        offers_refresh_config={"coordination": {"enabled": True, "slots": 2}},
+    )
+    offer_1 = Offer(1, 1, 100, 5, datetime.utcnow())
+    offer_2 = Offer(2, 2, 200, 10, datetime.utcnow())
+    core._offers_snapshot = {1: [offer_1], 2: [offer_2]}
+
+    # Offers of products in released slot are dropped, they are read from DB again
+    core._refresh_coordinator.owned_slots = frozenset({0})
+    await core._refresh_slots_changed()
+
+    assert core._offers_snapshot == {2: [offer_2]}
+
+
+async def test_offers_refresh_disabled(
+    offers_service: OffersService, prepared_db: Database
+) -> None:
+    # Worker without offers refresh keeps no snapshot and reads offers from DB
+    core = Core(
+        offers_service=offers_service,
+        db=prepared_db,
+        app_internal_token="",
+        offers_refresh_config={"enabled": False},
+    )
+
+    with aioresponses() as mocked_aio_response:  # type: ignore
+        mocked_aio_response.post("https://test-offers.com/api/v1/products/register")
+        product_id = await core.create_product("Product Name", "Product Description")
+
+    offer = Offer(1, product_id, 100, 5, datetime.utcnow())
+    await prepared_db.insert_new_offers([offer])
+    await core.load_offers_snapshot()
+
+    assert not core._offers_snapshot
+    assert not core.offers_refresh_stats()["products"]
+    assert await core.get_offers(product_id) == [offer]
+
+
+async def test_offers_refresh_remote_reads(
+    offers_service: OffersService, prepared_db: Database
+) -> None:
+    owner = Core(
+        offers_service=offers_service,
+        db=prepared_db,
+        app_internal_token="",
+        offers_refresh_config={"interval": 60, "hot_interval": 30},
+    )
+    worker = Core(
+        offers_service=offers_service,
+        db=prepared_db,
+        app_internal_token="",
+        offers_refresh_config={"enabled": False},
+    )
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+    await owner._sync_refresh_scheduler()
+    assert owner._refresh_scheduler.interval(product_id) == 60
+
+    # Reads in process not refreshing product (and of not existing product) are passed
+    # to process refreshing it through DB
+    await worker.get_offers(product_id)
+    await worker.get_offers(product_id + 1)
+    await worker._flush_pending_reads()
+    await owner._sync_refresh_scheduler()
+
+    assert owner._refresh_scheduler.interval(product_id) == 30
+    assert not await prepared_db.pop_product_reads(1, [0])
+
+
+async def test_adaptive_limiter() -> None:
+    limiter = AdaptiveLimiter(initial_limit=2, min_limit=1, max_limit=3, latency_threshold=1)
+
+    # Healthy calls increase limit up to max limit
+    for _ in range(10):
+        await limiter.acquire()
+        await limiter.release(latency=0.1, overloaded=False)
+
+    assert limiter.limit == 3
+
+    # Overloaded call halves limit
+    await limiter.acquire()
+    await limiter.release(latency=0.1, overloaded=True)
+
+    assert limiter.stats() == {"concurrency_limit": 1, "in_flight": 0}
+
+    # Calls over limit wait for release
+    await limiter.acquire()
+    waiting_call = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0.01)
+    assert not waiting_call.done()
+
+    await limiter.release(latency=0.1, overloaded=False)
+    await waiting_call
+    assert limiter.in_flight == 1
+
+
+def create_offers_service(**offers_config: Union[str, int, float]) -> OffersService:
+    return OffersService(
+        ClientSession(),
+        {"Bearer": "TEST"},
+        {
+            "offers_service_url": "https://test-offers.com/api/v1",
+            "offers_service_concurrency": 5,
+            "offers_service_retry_backoff": 0,
+            **offers_config,
+        },
+    )
+
+
+async def test_offers_service_retry() -> None:
+    offers_service = create_offers_service()
+    offers_url = "https://test-offers.com/api/v1/products/1/offers"
+
+    with aioresponses() as mocked_aio_response:  # type: ignore
+        mocked_aio_response.get(offers_url, status=503)
+        mocked_aio_response.get(
+            offers_url, payload=[{"id": 100, "price": 1000, "items_in_stock": 5}]
+        )
+
+        offers = await offers_service.get_offers(1)
+
+        # Client errors are not retried
+        mocked_aio_response.get(offers_url, status=404)
+        assert await offers_service.get_offers(1) is None
+
+    await offers_service.aclose()
+
+    assert offers is not None and [offer.id for offer in offers] == [100]
+    assert offers_service.pop_cycle_stats() == {
+        "success": 1,
+        "retried": 1,
+        "timed_out": 0,
+        "failed": 1,
+        "short_circuited": 0,
+        "shed": 0,
+    }
+
+
+async def test_offers_service_lazy_auth() -> None:
+    offers_service = OffersService(
+        ClientSession(),
+        None,
+        {"offers_service_url": "https://test-offers.com/api/v1", "offers_service_concurrency": 5},
+    )
+    assert not offers_service.authenticated
+
+    with aioresponses() as mocked_aio_response:  # type: ignore
+        # Only one auth call is made for concurrent calls
+        mocked_aio_response.post(
+            "https://test-offers.com/api/v1/auth", payload={"access_token": "TOKEN"}
+        )
+        for _ in range(2):
+            mocked_aio_response.get(
+                "https://test-offers.com/api/v1/products/1/offers",
+                payload=[{"id": 100, "price": 1000, "items_in_stock": 5}],
+            )
+
+        offers_lists = await asyncio.gather(
+            offers_service.get_offers(1), offers_service.get_offers(1)
+        )
+        auth_requests = mocked_aio_response.requests[
+            ("POST", URL("https://test-offers.com/api/v1/auth"))
+        ]
+
+    await offers_service.aclose()
+
+    assert offers_service.authenticated and len(auth_requests) == 1
+    assert all(offers is not None and len(offers) == 1 for offers in offers_lists)
+
+
+async def test_offers_service_timeout() -> None:
+    offers_service = create_offers_service(offers_service_retries=1)
+    offers_url = "https://test-offers.com/api/v1/products/1/offers"
+
+    with aioresponses() as mocked_aio_response:  # type: ignore
+        mocked_aio_response.get(offers_url, exception=asyncio.TimeoutError(), repeat=True)
+
+        assert await offers_service.get_offers(1) is None
+
+    await offers_service.aclose()
+
+    assert offers_service.pop_cycle_stats() == {
+        "success": 0,
+        "retried": 1,
+        "timed_out": 2,
+        "failed": 1,
+        "short_circuited": 0,
+        "shed": 0,
+    }
+
+
+async def test_offers_service_circuit_breaker() -> None:
+    offers_service = create_offers_service(
+        offers_service_retries=0,
+        offers_service_circuit_failures=2,
+        offers_service_circuit_reset_timeout=0.1,
+    )
+    offers_url = "https://test-offers.com/api/v1/products/1/offers"
+
+    with aioresponses() as mocked_aio_response:  # type: ignore
+        mocked_aio_response.get(offers_url, status=500)
+        mocked_aio_response.get(offers_url, status=500)
+
+        assert await offers_service.get_offers(1) is None
+        assert await offers_service.get_offers(1) is None
+        assert offers_service.circuit_breaker.state == "open"
+
+        # Open circuit fails fast without call to offers service
+        assert await offers_service.get_offers(1) is None
+
+        # Successful probe after reset timeout closes circuit
+        await asyncio.sleep(0.1)
+        mocked_aio_response.get(offers_url, payload=[])
+        assert await offers_service.get_offers(1) == []
+        assert offers_service.circuit_breaker.state == "closed"
+
+    await offers_service.aclose()
+
+    assert offers_service.pop_cycle_stats() == {
+        "success": 1,
+        "retried": 0,
+        "timed_out": 0,
+        "failed": 2,
+        "short_circuited": 1,
+        "shed": 0,
+    }
+
+
+async def test_offers_service_limiter_shed() -> None:
+    offers_service = create_offers_service(
+        offers_service_concurrency=1,
+        offers_service_concurrency_max=1,
+        offers_service_deadline=0.1,
+        offers_service_circuit_failures=1,
+    )
+
+    # Call waiting for concurrency slot until deadline is not failure of offers service
+    await offers_service.limiter.acquire()
+    assert await offers_service.get_offers(1) is None
+    await offers_service.limiter.release(0, False)
+
+    await offers_service.aclose()
+
+    assert offers_service.circuit_breaker.state == "closed"
+    assert offers_service.pop_cycle_stats() == {
+        "success": 0,
+        "retried": 0,
+        "timed_out": 0,
+        "failed": 0,
+        "short_circuited": 0,
+        "shed": 1,
+    }
+
+
+async def test_offers_service_cancelled_probe() -> None:
+    offers_service = create_offers_service(
+        offers_service_concurrency=1,
+        offers_service_concurrency_max=1,
+        offers_service_retries=0,
+        offers_service_deadline=0.2,
+        offers_service_circuit_failures=1,
+        offers_service_circuit_reset_timeout=0,
+    )
+    offers_url = "https://test-offers.com/api/v1/products/1/offers"
+
+    with aioresponses() as mocked_aio_response:  # type: ignore
+        mocked_aio_response.get(offers_url, status=500)
+        assert await offers_service.get_offers(1) is None
+        assert offers_service.circuit_breaker.state == "open"
+
+        # Probe waiting for concurrency slot is cancelled
+        await offers_service.limiter.acquire()
+        probe = asyncio.create_task(offers_service.get_offers(1))
+        await asyncio.sleep(0.05)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        # Wait for concurrency slot is limited by call deadline
+        started_at = time.monotonic()
+        assert await offers_service.get_offers(1) is None
+        assert time.monotonic() - started_at < 0.5
+        await offers_service.limiter.release(0, False)
+
+        mocked_aio_response.get(offers_url, payload=[])
+        assert await offers_service.get_offers(1) == []
+        assert offers_service.circuit_breaker.state == "closed"
+
+    await offers_service.aclose()
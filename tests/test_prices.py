@@ -1,11 +1,12 @@
 # pylint: disable=unused-argument
 
-from datetime import datetime
+import asyncio
+from datetime import datetime, timedelta
 from typing import Dict
 
 import pytest
 from aiohttp import ClientSession
-from applifting_exercise.database import Database
+from applifting_exercise.database import PRICES_ROLLUPS_LOCK_KEY, Database
 from applifting_exercise.models import Offer
 
 INVALID_JSON_DATA = [
@@ -70,3 +71,162 @@ async def test_prices_fall(prepared_db: Database, test_web_server: None, api_url
             prices_json = await response.json()
 
     assert prices_json == {"percentage": 50, "prices": [200, 100]}
+
+
+async def test_prices_percentage_only(
+    prepared_db: Database, test_web_server: None, api_url_v1: str
+) -> None:
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    offer_1 = Offer(1, product_id, 300, 5, datetime.fromisoformat("2022-04-21T11:00:00"))
+    offer_2 = Offer(2, product_id, 100, 5, datetime.fromisoformat("2022-04-21T12:00:00"))
+    offer_3 = Offer(3, product_id, 200, 5, datetime.fromisoformat("2022-04-21T13:00:00"))
+
+    await prepared_db.insert_new_offers([offer_1, offer_2, offer_3])
+
+    async with ClientSession() as session:
+        async with session.get(
+            f"{api_url_v1}/products/{product_id}/prices",
+            json={**FROM_TO_PRICES_JSON, "include_prices": False},
+        ) as response:
+            assert response.status == 200
+            prices_json = await response.json()
+
+    assert prices_json == {"percentage": 33}
+
+
+async def test_prices_not_found(
+    prepared_db: Database, test_web_server: None, api_url_v1: str
+) -> None:
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    async with ClientSession() as session:
+        async with session.get(
+            f"{api_url_v1}/products/{product_id}/prices", json=FROM_TO_PRICES_JSON
+        ) as response:
+            assert response.status == 404
+
+
+async def test_prices_history(
+    prepared_db: Database, test_web_server: None, api_url_v1: str
+) -> None:
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    offers = [
+        Offer(1, product_id, 100, 5, datetime.fromisoformat("2022-04-21T10:10:00")),
+        Offer(2, product_id, 300, 5, datetime.fromisoformat("2022-04-21T10:20:00")),
+        Offer(3, product_id, 200, 5, datetime.fromisoformat("2022-04-21T10:30:00")),
+        Offer(4, product_id, 400, 5, datetime.fromisoformat("2022-04-21T12:00:00")),
+        Offer(5, product_id, 500, 5, datetime.fromisoformat("2022-04-21T16:00:00")),
+    ]
+
+    await prepared_db.insert_new_offers(offers)
+
+    async with ClientSession() as session:
+        async with session.get(
+            f"{api_url_v1}/products/{product_id}/prices_history",
+            json={**FROM_TO_PRICES_JSON, "bucket": "1h"},
+        ) as response:
+            assert response.status == 200
+            history_json = await response.json()
+
+        async with session.get(
+            f"{api_url_v1}/products/{product_id}/prices_history",
+            json={**FROM_TO_PRICES_JSON, "bucket": "invalid"},
+        ) as response:
+            assert response.status == 400
+
+    # Offer created at to_date is not included
+    assert history_json == {
+        "buckets": [
+            {
+                "start": "2022-04-21T10:00:00",
+                "open": 100,
+                "high": 300,
+                "low": 100,
+                "close": 200,
+                "avg": 200,
+                "count": 3,
+            },
+            {
+                "start": "2022-04-21T12:00:00",
+                "open": 400,
+                "high": 400,
+                "low": 400,
+                "close": 400,
+                "avg": 400,
+                "count": 1,
+            },
+        ]
+    }
+
+
+async def test_prices_rollups(prepared_db: Database) -> None:
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    offers = [
+        Offer(1, product_id, 200, 5, datetime.fromisoformat("2022-04-21T10:10:00")),
+        Offer(2, product_id, 100, 5, datetime.fromisoformat("2022-04-21T10:20:00")),
+        Offer(3, product_id, 400, 5, datetime.fromisoformat("2022-04-21T11:30:00")),
+        Offer(4, product_id, 300, 5, datetime.fromisoformat("2022-04-21T11:40:00")),
+    ]
+
+    # Rollups are updated incrementally, duplicated offers are not counted
+    await prepared_db.insert_new_offers(offers[:3])
+    await prepared_db.insert_new_offers(offers[1:])
+
+    from_date = datetime.fromisoformat("2022-04-21T00:00:00")
+    to_date = datetime.fromisoformat("2022-04-22T00:00:00")
+
+    daily_history = await prepared_db.get_prices_history(
+        product_id, from_date, to_date, timedelta(days=1)
+    )
+    assert [bucket.for_api for bucket in daily_history] == [
+        {
+            "start": "2022-04-21T00:00:00",
+            "open": 200,
+            "high": 400,
+            "low": 100,
+            "close": 300,
+            "avg": 250,
+            "count": 4,
+        }
+    ]
+
+    hourly_history = await prepared_db.get_prices_history(
+        product_id, from_date, to_date, timedelta(hours=1)
+    )
+
+    # Backfill computes the same rollups from offers
+    async with prepared_db.pg_pool.acquire() as con:
+        await con.execute("TRUNCATE prices_hourly, prices_daily")
+
+    await prepared_db.backfill_prices_rollups()
+
+    assert (
+        await prepared_db.get_prices_history(product_id, from_date, to_date, timedelta(days=1))
+        == daily_history
+    )
+    assert (
+        await prepared_db.get_prices_history(product_id, from_date, to_date, timedelta(hours=1))
+        == hourly_history
+    )
+
+
+async def test_insert_offers_during_rollups_backfill(prepared_db: Database) -> None:
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+    offer = Offer(1, product_id, 200, 5, datetime.fromisoformat("2022-04-21T10:10:00"))
+
+    # Insert of offers waits until backfill of rollups holding lock commits
+    async with prepared_db.pg_pool.acquire() as con:
+        async with con.transaction():
+            await con.execute("SELECT pg_advisory_xact_lock($1)", PRICES_ROLLUPS_LOCK_KEY)
+            insert_task = asyncio.create_task(prepared_db.insert_new_offers([offer]))
+            await asyncio.sleep(0.1)
+            assert not insert_task.done()
+
+    assert (await insert_task).inserted == 1
@@ -1,11 +1,16 @@
 # pylint: disable=unused-argument
 
-from typing import Dict
+import asyncio
+from typing import Dict, Optional
 
 import pytest
 from aiohttp import ClientSession
 from aioresponses import aioresponses
+from applifting_exercise.core import Core
 from applifting_exercise.database import Database
+from applifting_exercise.exceptions import ProductIdNotExists
+from applifting_exercise.models import Product
+from applifting_exercise.services import OffersService
 
 INVALID_JSON_DATA = [
     {"name": "", "description": "Product Description"},
@@ -166,3 +171,68 @@ async def test_delete_product(
 
     product = await prepared_db.get_product(product_id)
     assert product is None
+
+
+async def test_product_cache(offers_service: OffersService, prepared_db: Database) -> None:
+    core = Core(offers_service=offers_service, db=prepared_db, app_internal_token="")
+
+    with pytest.raises(ProductIdNotExists):
+        await core.get_product(1)
+
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    # Not found product is cached
+    with pytest.raises(ProductIdNotExists):
+        await core.get_product(product_id)
+
+    # Update invalidates cached product
+    await core.update_product(Product(product_id, "Product Name Updated", "Product Description"))
+
+    product = await core.get_product(product_id)
+    assert product.name == "Product Name Updated"
+
+    product = await core.get_product(product_id)
+    assert product.name == "Product Name Updated"
+
+    assert core.cache_stats()["products"]["hits"] == 2
+    assert core.cache_stats()["products"]["misses"] == 2
+
+
+async def test_product_cache_read_during_update(
+    offers_service: OffersService, prepared_db: Database
+) -> None:
+    core = Core(offers_service=offers_service, db=prepared_db, app_internal_token="")
+    product_id = (await prepared_db.create_product("Product Name", "Product Description")).id
+
+    db_get_product = prepared_db.get_product
+    product_read = asyncio.Event()
+    product_updated = asyncio.Event()
+
+    async def get_product_before_update(product_id: int) -> Optional[Product]:
+        product = await db_get_product(product_id)
+        product_read.set()
+        await product_updated.wait()
+        return product
+
+    # Product is read from DB before update and read is finished after update
+    prepared_db.get_product = get_product_before_update  # type: ignore
+    read_task = asyncio.create_task(core.get_product(product_id))
+    await product_read.wait()
+    prepared_db.get_product = db_get_product  # type: ignore
+
+    await core.update_product(Product(product_id, "Product Name Updated", "Product Description"))
+    product_updated.set()
+    assert (await read_task).name == "Product Name"
+
+    # Product read before update is not cached
+    product = await core.get_product(product_id)
+    assert product.name == "Product Name Updated"
+
+
+async def test_iter_products_ids(prepared_db: Database) -> None:
+    products_ids = [
+        (await prepared_db.create_product(f"Product {index}", "Product Description")).id
+        for index in range(5)
+    ]
+
+    assert [product_id async for product_id in prepared_db.iter_products_ids(2)] == products_ids
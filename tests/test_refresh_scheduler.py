@@ -0,0 +1,110 @@
+# pylint: disable=protected-access
+
+import asyncio
+import time
+from typing import AsyncIterator, List
+
+from applifting_exercise.database import Database
+from applifting_exercise.refresh_coordinator import RefreshCoordinator
+from applifting_exercise.refresh_scheduler import RefreshScheduler
+
+
+async def iter_ids(products_ids: List[int]) -> AsyncIterator[int]:
+    for product_id in products_ids:
+        yield product_id
+
+
+async def test_refresh_scheduler_intervals() -> None:
+    scheduler = RefreshScheduler(
+        {"interval": 60, "hot_interval": 30, "cold_interval": 300, "interval_overrides": {"3": 5}}
+    )
+
+    scheduler.add(1)
+    scheduler.record_read(1)
+
+    assert scheduler.interval(1) == 30
+    assert scheduler.interval(2) == 60
+    assert scheduler.interval(3) == 5
+
+    scheduler.set_interval_override(3, None)
+    assert scheduler.interval(3) == 60
+
+    # Products not read for cold_after are cold
+    cold_scheduler = RefreshScheduler({"cold_after": 0, "cold_interval": 300})
+    assert cold_scheduler.interval(1) == 300
+
+
+async def test_refresh_scheduler_next_due() -> None:
+    scheduler = RefreshScheduler({"interval": 60, "interval_overrides": {"1": 0.05}})
+
+    scheduler.add(1, delay=0)
+    scheduler.add(2)
+
+    assert await asyncio.wait_for(scheduler.next_due(), 1) == 1
+    assert scheduler.stats() == {"products": 2, "in_flight": 1, "lag": 0}
+
+    # Product is due again after its interval
+    scheduler.done(1)
+    assert await asyncio.wait_for(scheduler.next_due(), 1) == 1
+
+    # Read product is due at latest after hot interval
+    scheduler.record_read(2)
+    due_in = scheduler._due_at[2] - time.monotonic()
+    assert due_in <= 30
+
+
+async def test_refresh_scheduler_unknown_read() -> None:
+    scheduler = RefreshScheduler()
+    scheduler.add(1)
+
+    # Reads of products which are not scheduled are not kept
+    for product_id in range(2, 100):
+        scheduler.record_read(product_id)
+
+    assert not scheduler._last_read_at
+    assert scheduler.stats()["products"] == 1
+
+
+async def test_refresh_scheduler_lag() -> None:
+    scheduler = RefreshScheduler()
+
+    scheduler.add(1, delay=-20)
+
+    assert scheduler.stats()["lag"] >= 20
+
+    assert await scheduler.next_due() == 1
+    assert not scheduler.stats()["lag"]
+
+
+async def test_refresh_scheduler_sync() -> None:
+    scheduler = RefreshScheduler()
+
+    await scheduler.sync(iter_ids([1, 2, 3]))
+    assert scheduler.stats()["products"] == 3
+
+    # Product 2 is deleted, product 5 created after sync is kept
+    scheduler.add(5)
+    await scheduler.sync(iter_ids([1, 3]))
+
+    assert sorted(scheduler._due_at) == [1, 3, 5]
+
+
+async def test_refresh_coordinator(prepared_db: Database) -> None:
+    config = {"enabled": True, "slots": 4, "lease_ttl": 1}
+    coordinator_a = RefreshCoordinator(prepared_db, {**config, "replica_id": "a"})
+    coordinator_b = RefreshCoordinator(prepared_db, {**config, "replica_id": "b"})
+
+    assert await coordinator_a._update_leases() == {0, 1, 2, 3}
+
+    # Replica over fair share releases slots for new replica
+    assert not await coordinator_b._update_leases()
+    assert await coordinator_a._update_leases() == {0, 1}
+    assert await coordinator_b._update_leases() == {2, 3}
+
+    # Leases of dead replica expire and are taken over
+    await asyncio.sleep(1.1)
+    assert await coordinator_b._update_leases() == {0, 1, 2, 3}
+    assert coordinator_b.stats() == {"replica_id": "b", "slots": 4, "owned_slots": 0}
+
+    # Without coordination all products are owned
+    assert RefreshCoordinator(prepared_db).owns(123)
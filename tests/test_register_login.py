@@ -4,6 +4,11 @@ from typing import Dict
 
 import pytest
 from aiohttp import ClientSession
+from applifting_exercise.core import Core
+from applifting_exercise.database import Database
+from applifting_exercise.exceptions import PasswordHashingOverloaded
+from applifting_exercise.password_hasher import PasswordHasher
+from applifting_exercise.services import OffersService
 from jose import jwt
 
 INVALID_JSON_DATA = [
@@ -82,3 +87,21 @@ async def test_correct_register_login(
             test_res_login = await response.json()
 
         validate_token(test_res_login["token"])
+
+
+async def test_password_hashing_overloaded(
+    offers_service: OffersService, prepared_db: Database
+) -> None:
+    # Hashing jobs over limit are rejected without hashing
+    password_hasher = PasswordHasher({"max_queued": 0})
+    core = Core(
+        offers_service=offers_service,
+        db=prepared_db,
+        app_internal_token="",
+        password_hasher=password_hasher,
+    )
+
+    with pytest.raises(PasswordHashingOverloaded):
+        await core.login("Username", "TestPWD123456")
+
+    await password_hasher.aclose()
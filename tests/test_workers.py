@@ -0,0 +1,105 @@
+import asyncio
+import os
+import re
+import sys
+from typing import Dict
+from urllib.parse import urlparse
+
+import pytest
+from aiohttp import ClientError, ClientSession, TCPConnector
+from applifting_exercise.__main__ import worker_pool_config
+from applifting_exercise.web import PREFIX_V1
+
+WEB_PORT = 8097
+METRICS_PORT = 9197
+
+
+def test_worker_pool_config() -> None:
+    # DB pool sizes are split between workers
+    pg_config = {"dsn": "postgresql://localhost/db", "min_size": 2, "max_size": 90}
+    assert worker_pool_config(pg_config, 16) == {
+        "dsn": "postgresql://localhost/db",
+        "min_size": 2,
+        "max_size": 5,
+    }
+    assert worker_pool_config(pg_config, 90)["min_size"] == 1
+
+    with pytest.raises(ValueError):
+        worker_pool_config(pg_config, 91)
+
+
+async def scrape_workers_metrics(session: ClientSession, workers: int) -> Dict[int, str]:
+    # Wait until every worker serves metrics on its own port
+    metrics: Dict[int, str] = {}
+
+    for _ in range(300):
+        for worker_index in range(workers):
+            try:
+                async with session.get(
+                    f"http://localhost:{METRICS_PORT + worker_index}/metrics"
+                ) as response:
+                    metrics[worker_index] = await response.text()
+            except ClientError:
+                pass
+
+        if len(metrics) == workers:
+            return metrics
+
+        await asyncio.sleep(0.1)
+
+    raise TimeoutError("Workers did not start")
+
+
+async def test_workers_metrics(postgres_dsn: str) -> None:
+    dsn = urlparse(postgres_dsn)
+    env = {
+        **os.environ,
+        "APP_INTERNAL_TOKEN": "TEST_INTERNAL_TOKEN",
+        "POSTGRES_HOST": str(dsn.hostname),
+        "POSTGRES_PORT": str(dsn.port),
+        "POSTGRES_DBNAME": dsn.path.lstrip("/"),
+        "POSTGRES_USERNAME": str(dsn.username),
+        "POSTGRES_PASSWORD": str(dsn.password),
+        "PORT": str(WEB_PORT),
+        "METRICS_PORT": str(METRICS_PORT),
+        "OFFERS_SERVICES_URL": "http://localhost:1/api/v1",
+    }
+    # App is started as by its script, spawned workers import it by module name
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-c",
+        "from applifting_exercise.__main__ import main; main()",
+        "--workers",
+        "2",
+        env=env,
+    )
+    requests_count = 20
+
+    try:
+        # Every request on new connection, connections are balanced between workers
+        async with ClientSession(connector=TCPConnector(force_close=True)) as session:
+            await scrape_workers_metrics(session, 2)
+
+            for _ in range(requests_count):
+                async with session.get(
+                    f"http://localhost:{WEB_PORT}{PREFIX_V1}/products/0"
+                ) as response:
+                    assert response.status == 404
+
+            metrics = await scrape_workers_metrics(session, 2)
+    finally:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), 30)
+
+    # Series of workers are distinct and together they count all requests
+    counts = []
+    for worker_index, worker_metrics in metrics.items():
+        match = re.search(
+            r'^http_request_duration_seconds_count\{route="/api/v1/products/\{product_id\}",'
+            rf'method="GET",status="404",worker="{worker_index}"\}} (\d+)$',
+            worker_metrics,
+            re.MULTILINE,
+        )
+        counts.append(int(match.group(1)) if match else 0)
+
+    assert sum(counts) == requests_count